@@ -0,0 +1,164 @@
+""" Array jobs: submit all the jobs of a batch at once
+
+Instead of one llsubmit or qsub call per job, the jobs of a batch are
+prepared first, then submitted with a single call (see --array in job and
+gjob_eolo):
+
+    ll  : a LoadLeveler job with one step per job, each step gets its
+          index as argument
+    sge : an SGE array job (qsub -t 1-N), each task gets its index in
+          SGE_TASK_ID
+
+Each step or task reads its output folder (and the key of the run, if
+any) from that line of the file 'array.list' in the output directory. The
+folders are listed as absolute paths, since the steps may start in another
+directory. If a cache file is given, each step appends its exit code with
+the key of its run to it (see scheduler.read_cache).
+
+Examples
+--------
+>>> submit("sico.x", ["output/runs/a/", "output/runs/b/"], "output/runs/", 24, "llsubmit", command)
+"""
+import os
+
+import instrument
+import monitor
+
+LIST_FILE = 'array.list'      # Output folder (and key) of each job, one per line
+JOBSCRIPT = 'array.submit'    # Name of job submit script
+
+def listing(outfldrs, keys=None):
+    " text of the list file: absolute output folder (and key) of each job "
+    lines = []
+    for k, outfldr in enumerate(outfldrs):
+        line = os.path.abspath(outfldr) + "/"
+        if keys: line = line + " " + keys[k]
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def _record(cachefile):
+    " shell lines recording the exit code of the job in cachefile (see run_key in job) "
+    if not cachefile:
+        return ""
+    return """status=$?
+
+# Record the exit code of the job (see run_key)
+echo "{\\"hash\\": \\"$key\\", \\"run\\": \\"$outfldr\\", \\"exit\\": $status}" >> %s
+""" % (os.path.abspath(cachefile))
+
+def jobscript_ll(executable,listfile,outfldrs,username,usergroup,wtime,cachefile=None):
+    '''Definition of the LoadLeveler job script: one job step per output
+       folder, which reads its folder from listfile
+    '''
+
+    script = """#!/bin/ksh
+# @ class = medium
+# @ group = %s
+# @ job_type = serial
+# @ as_limit = unlimited
+# @ data_limit = unlimited
+# @ stack_limit = unlimited
+# @ file_limit = unlimited
+# @ nofile_limit = unlimited
+# @ core_limit = unlimited
+# @ input = /dev/null
+# @ notify_user = %s@pik-potsdam.de
+# @ notification = never
+# @ Wall_clock_limit = %s:00:00
+# @ checkpoint = no
+"""  % (usergroup,username,wtime)
+
+    steps = []
+    for k, outfldr in enumerate(outfldrs):
+        steps.append("""# @ arguments = %i
+# @ output = %sout.out
+# @ error = %sout.err
+# @ queue
+""" % (k+1,outfldr,outfldr))
+    script = script + "".join(steps)
+
+    script = script + """
+ulimit -c unlimited
+ulimit -s unlimited
+ulimit -d unlimited
+ulimit -m unlimited
+ulimit -v unlimited
+ulimit -f unlimited
+ulimit -a
+
+# Output folder (and key) of this job step
+set -- `sed -n "${1}p" %s`
+outfldr=$1
+key=$2
+
+./%s $outfldr
+""" % (listfile,executable)
+
+    return script + _record(cachefile)
+
+def jobscript_sge(executable,listfile,njobs,wtime,cachefile=None):
+    '''Definition of the SGE job script: an array job, task i runs in the
+       output folder given on line i of listfile
+    '''
+
+    script = """#!/bin/bash
+#$ -V                             # Ensure user enivronment variables are available
+#$ -cwd                           # To use the current directory
+#$ -m a                           # Send mail when a task is aborted (a)
+#$ -N rembo_sico                  # (nombre del trabajo)
+#$ -t 1-%i                        # (tareas: una por carpeta de salida)
+#$ -o /dev/null                   # (salida en out.out de cada carpeta)
+#$ -e /dev/null
+####$ -l walltime=%s:00:00            # Set wall time (hh:mm:ss)
+
+# Output folder (and key) of this task
+set -- $(sed -n "${SGE_TASK_ID}p" %s)
+outfldr=$1
+key=$2
+
+# Run the job
+cd $outfldr
+time ./%s > out.out 2> out.err
+"""  % (njobs,wtime,listfile,executable)
+
+    return script + _record(cachefile)
+
+def submit(executable,outfldrs,outfldr,wtime,submitter,command,queue="ll",
+           username=None,usergroup="tumble",keys=None,cachefile=None):
+    '''Write the list file and job script of the jobs of a batch in outfldr,
+       submit them at once with the command submitter (llsubmit or qsub),
+       and record the job of each folder for the queue monitor.
+       command runs a shell command and returns (output,errors).
+       Returns the job id, or None if the jobs were not submitted.
+    '''
+    username = username or os.environ.get('USER')
+    listfile = os.path.abspath(outfldr + LIST_FILE)
+
+    with instrument.phase("jobscript",jobs=len(outfldrs)):
+        text = listing(outfldrs,keys)
+        open(listfile,'w').write(text)
+        if queue == "sge":
+            script = jobscript_sge(executable,listfile,len(outfldrs),wtime,cachefile)
+        else:
+            script = jobscript_ll(executable,listfile,outfldrs,username,usergroup,wtime,cachefile)
+        open(outfldr + JOBSCRIPT,'w').write(script)
+    instrument.count("files_written",2); instrument.count("bytes_written",len(text)+len(script))
+    print "Created jobscript file: " + outfldr + JOBSCRIPT
+
+    # Send the submit command to the queue, once for all jobs
+    stat = command("%s %s" % (submitter,outfldr + JOBSCRIPT))
+    print stat[0]
+
+    # Record the job (step or array task) of each folder for the queue monitor
+    jobid = monitor.parse_submit(stat[0])
+    if jobid is None:
+        print "Error in job submission: job not submitted!"
+        print stat[1]
+        return None
+    for k, fldr in enumerate(outfldrs):
+        if queue == "sge":
+            monitor.record(outfldr,fldr,"%s.%i" % (jobid,k+1),queue="sge")
+        else:
+            monitor.record(outfldr,fldr,"%s.%i" % (jobid,k))
+
+    return jobid
@@ -0,0 +1,469 @@
+""" Benchmarks for the parsers, writers and batch materialisation
+
+Usage:
+    bench.py [--size=<n>] [--members=<n>] [--jobs=<n>] [--repeat=<n>] [--stages=<names>] [--save=<file>] [--compare=<file>] [--tolerance=<x>]
+
+Options:
+    --size=<n>          number of parameters in the synthetic files [default: 10000]
+    --members=<n>       number of members of the synthetic sweep [default: 10000]
+    --jobs=<n>          number of members materialised with job's makejob [default: 100]
+    --repeat=<n>        number of timed repetitions, the best is kept [default: 5]
+    --stages=<names>    comma-separated stage names, or prefixes (e.g. nml,sweep)
+    --save=<file>       save the results as a JSON baseline
+    --compare=<file>    compare to a JSON baseline, and flag regressions
+    --tolerance=<x>     relative slow-down (or memory increase) flagged as regression [default: 0.2]
+
+The synthetic files are made by replicating the parameters of the files in
+examples/ (params.nml, options_rembo, options_sico, run) with new names,
+up to the requested size. The nml.load stages read such a file from disk,
+by parsing it or from the cache of parsed files (see cache.py), which is
+kept in a temporary directory (and not used by the other stages). Each
+stage runs in a child process, which reports its best wall time and the
+growth of its peak memory (RSS) during the stage.
+The exit status is 1 if a regression was flagged.
+"""
+from collections import OrderedDict
+from cStringIO import StringIO
+import itertools
+import resource
+import shutil
+import tempfile
+import imp
+import json
+import re
+import sys
+import time
+import os
+
+from namelist import Namelist
+import parameters
+import cache
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+
+#
+# Reference implementation: the regex-based parser Namelist.parse_file
+# used before the single-pass tokenizer, with its value parser, kept for
+# comparison.
+#
+def parse_value_regex(variable_value):
+    """
+    Tries to parse a single value, raises an exception if no single value is matched
+    """
+    try:
+        parsed_value = int(variable_value)
+    except ValueError:
+        try:
+            parsed_value = float(variable_value)
+        except ValueError:
+            if variable_value.lower() in ['.true.', 't']:
+                # boolean
+                parsed_value = True
+            elif variable_value.lower() in ['.false.', 'f']:
+                parsed_value = False
+            elif variable_value.startswith("'") \
+                and variable_value.endswith("'") \
+                and variable_value.count("'") == 2 \
+            or variable_value.startswith('"') \
+                and variable_value.endswith('"') \
+                and variable_value.count('"') == 2:
+                # string
+                parsed_value = variable_value[1:-1]
+            elif variable_value.startswith("/") and variable_value.endswith("/"):
+                # array /3,4,5/
+                parsed_value = []
+                for v in variable_value[1:-1].split(','):
+                    parsed_value.append(parse_value_regex(v))
+            elif len(variable_value.split()) > 1:
+                # array 3 4 5
+                parsed_value = []
+                for v in variable_value.split(' '):
+                    parsed_value.append(parse_value_regex(v))
+            else:
+                raise ValueError(variable_value)
+
+    return parsed_value
+
+def parse_file_regex(input_str):
+    groups = OrderedDict()
+    group_re = re.compile(r'&([^&]+)/', re.DOTALL)
+
+    filtered_lines = []
+    for line in input_str.split('\n'):
+        if '!' in line:
+            line = line[:line.index('!')]
+        if line.strip() == "":
+            continue
+        else:
+            filtered_lines.append(line)
+
+    group_blocks = re.findall(group_re, "\n".join(filtered_lines))
+
+    for group_block in group_blocks:
+        block_lines = group_block.split('\n')
+        group_name = block_lines.pop(0).strip()
+        group = OrderedDict()
+        for line in block_lines:
+            line = line.strip()
+            if line == "":
+                continue
+            if line.endswith(','):
+                line = line[:-1]
+            k, v = line.split('=')
+            group[k.strip()] = parse_value_regex(v.strip())
+        groups[group_name] = group
+
+    return Namelist(groups)
+
+# Reference implementation: value parser of parameters.py, before parse_literal
+def parse_value_eval(v):
+    try:
+        return eval(v)
+    except:
+        return v
+
+
+#
+# Synthetic input files
+#
+def make_nml(ngroups=200, nvars=50):
+    """ Return a namelist string with ngroups groups of nvars variables each,
+    cycling through the value types found in examples/params.nml
+    """
+    samples = ["917", "9.81", "3.5e-25", "60000.", '"from_file"', "'out'",
+               ".true.", "250. -0.008 0. 0."]
+    lines = []
+    for g in range(ngroups):
+        lines.append("&group{}   ! group comment".format(g))
+        for v in range(nvars):
+            lines.append("    var{} = {},   ! variable comment (units)".format(
+                v, samples[v % len(samples)]))
+        lines.append("/")
+        lines.append("")
+    return "\n".join(lines)
+
+def scale_nml(size, filename="params.nml"):
+    " replicate the groups of an example namelist (renamed) up to size variables "
+    text = open(os.path.join(EXAMPLES, filename)).read()
+    nvars = sum(len(g) for g in Namelist.parse_file(text).groups.itervalues())
+    copies = []
+    for k in range(max(1, size // nvars)):
+        copies.append(re.sub(r"^(\s*)&(\w+)", r"\1&\2_{}".format(k), text, flags=re.M))
+    return "\n".join(copies)
+
+def _is_param_alex(line):
+    return len(line) > 41 and line.strip()[0] != "#" and line[40] in ("=", ":")
+
+def scale_alex(size, filename="options_rembo"):
+    " replicate the parameter lines of an example alex file (renamed) up to size parameters "
+    lines = open(os.path.join(EXAMPLES, filename)).read().splitlines()
+    params = [l for l in lines if _is_param_alex(l)]
+    out = [l for l in lines if not _is_param_alex(l)] # comments, once
+    for k in range(max(1, size // len(params))):
+        for l in params:
+            name = "  {}_{}".format(l[10:40].strip()[:20], k)
+            out.append("{}{:<30}{}".format(l[:10], name, l[40:]))
+    return "\n".join(out) + "\n"
+
+def scale_climber2(size, filename="run"):
+    " replicate the parameter lines of an example climber2 file (renamed) up to size parameters "
+    lines = open(os.path.join(EXAMPLES, filename)).read().splitlines()
+    params = [l for l in lines if l.strip() and l.strip()[0] != "=" and l.count("|") >= 2]
+    out = [l for l in lines if l not in params]
+    for k in range(max(1, size // len(params))):
+        for l in params:
+            value, name, rest = l.split("|", 2)
+            out.append("|".join([value, " {}_{} ".format(name.strip(), k), rest]))
+    return "\n".join(out) + "\n"
+
+def sweep_args(members):
+    " job arguments of a sweep of about that many members, over 3 rembo parameters "
+    n = max(1, int(round(members ** (1./3))))
+    m = max(1, members // (n*n))
+    values = lambda k: ",".join(str(0.5+0.01*i) for i in range(k))
+    return ["pdd_factor=" + values(n), "T_warming=" + values(n), "T_diff=" + values(m)]
+
+def load_job():
+    " import the job script as a module "
+    return imp.load_source("job", os.path.join(os.path.dirname(os.path.abspath(__file__)), "job"))
+
+
+#
+# Timing
+#
+def timeit(func, args=(), repeat=5):
+    " return the best wall time over repeat calls, in seconds "
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        func(*args)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+def measure(setup, func, repeat=5):
+    """ time func(setup()) in a child process, and return
+    (best time in s, growth of the peak memory in kB)
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        code = 0
+        try:
+            data = setup()
+            rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            best = timeit(func, (data,), repeat)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0
+            os.write(w, json.dumps([best, rss]))
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(w)
+    result = ""
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        result += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not result:
+        raise RuntimeError("benchmark stage failed")
+    return tuple(json.loads(result))
+
+def bench_parse_nml(ngroups=200, nvars=50, repeat=5):
+    " compare the tokenizer to the regex parser on a synthetic file "
+    string = make_nml(ngroups, nvars)
+    assert Namelist.parse_file(string).groups == parse_file_regex(string).groups
+    results = OrderedDict()
+    results['regex'] = timeit(parse_file_regex, (string,), repeat)
+    results['tokenizer'] = timeit(Namelist.parse_file, (string,), repeat)
+    return results
+
+def bench_parse_values(repeat=5, number=20):
+    """ compare parse_literal to eval when reading the example files
+    (each file is read number times per timing)
+    """
+    files = [(os.path.join(EXAMPLES, "options_rembo"), parameters.Parameters.read_alex),
+             (os.path.join(EXAMPLES, "options_sico"), parameters.Parameters.read_alex),
+             (os.path.join(EXAMPLES, "run"), parameters.Parameters.read_climber2)]
+    def read_all():
+        for _ in xrange(number):
+            for fname, read in files:
+                read(fname, verbose=False)
+
+    results = OrderedDict()
+    fast = parameters._parse_value
+    try:
+        parameters._parse_value = parse_value_eval
+        results['eval'] = timeit(read_all, (), repeat)
+    finally:
+        parameters._parse_value = fast
+    results['parse_literal'] = timeit(read_all, (), repeat)
+    return results
+
+
+#
+# Stages: name ==> (setup, function of the setup's result)
+#
+def _quiet(func, *args, **kwargs):
+    " call func without printing anything "
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+def _sweep(data):
+    " consume the parameter sets of the sweep given by job arguments "
+    job, args = data
+    sets, n = _quiet(job.parse_args, list(args), force=True)
+    for params in sets:
+        pass
+
+def _makejobs(data):
+    job, folder, sets = data
+    for params in sets:
+        _quiet(job.makejob, params, folder, "24", "rembo.x", auto=True, force=True)
+
+def _makejob_setup(njobs, workdir):
+    " job and njobs parameter sets, in a working directory with the example options "
+    job = load_job()
+    tmp = tempfile.mkdtemp(dir=workdir)
+    for name in ("options_rembo", "options_sico"):
+        shutil.copy(os.path.join(EXAMPLES, name), tmp)
+    os.chdir(tmp)
+    sets, n = _quiet(job.parse_args, sweep_args(njobs), force=True)
+    return job, os.path.join(tmp, "output") + "/", list(itertools.islice(sets, njobs))
+
+def _load_setup(size, workdir, cached):
+    " a synthetic namelist file, read once to fill the cache of parsed files (or without cache) "
+    filename = os.path.join(tempfile.mkdtemp(dir=workdir), "params.nml")
+    with open(filename, "w") as f:
+        f.write(scale_nml(size))
+    os.utime(filename, (time.time()-60, time.time()-60))  # not modified just now (see cache.RACY)
+    cache.DIRECTORY = os.path.join(workdir, "cache") if cached else "off"
+    parameters.Parameters.read_nml(filename, verbose=False)
+    return filename
+
+def _load(filename):
+    parameters.Parameters.read_nml(filename, verbose=False)
+
+def _lookup_setup(size, workdir):
+    " a synthetic options file, and the name of its middle parameter "
+    filename = os.path.join(tempfile.mkdtemp(dir=workdir), "options_rembo")
+    with open(filename, "w") as f:
+        f.write(scale_alex(size))
+    params = parameters._parse_file_alex(parameters.Parameters, open(filename).read())
+    return filename, params[len(params)//2].name
+
+def _lookup(data, lazy=False):
+    " read an options file and get one parameter "
+    filename, name = data
+    parameters.Parameters.read_alex(filename, verbose=False, lazy=lazy).filter(name=name)
+
+def _table_setup(members):
+    schema = parameters.Parameters.read_alex(os.path.join(EXAMPLES, "options_rembo"), verbose=False)
+    sets = [[parameters.Parameter(name="pdd_factor", value=0.5+0.01*i),
+             parameters.Parameter(name="T_warming", value=float(i % 7))] for i in xrange(members)]
+    return schema, sets
+
+def _table(data):
+    schema, sets = data
+    table = parameters.ParameterTable(schema)
+    table.extend(sets)
+    for i in xrange(0, len(table), max(1, len(table) // 100)):
+        parameters._to_str_alex(table.to_parameters(i))
+
+def _write_setup(nfiles, workdir):
+    " table of nfiles members, and a file name for each, in a new directory "
+    schema, sets = _table_setup(nfiles)
+    table = parameters.ParameterTable(schema)
+    table.extend(sets)
+    tmp = tempfile.mkdtemp(dir=workdir)
+    return table, [os.path.join(tmp, str(i), "options_rembo") for i in xrange(nfiles)]
+
+def _write(data):
+    " write each member as a Parameters instance "
+    table, filenames = data
+    for i, filename in enumerate(filenames):
+        folder = os.path.dirname(filename)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        table.to_parameters(i).write_alex(filename, verbose=False)
+
+def _write_bulk(data):
+    table, filenames = data
+    table.write(filenames, "alex")
+
+def stages(size, members, njobs, workdir):
+    P = parameters.Parameters
+    nml = lambda: scale_nml(size)
+    alex = lambda: scale_alex(size)
+    climber2 = lambda: scale_climber2(size)
+    return OrderedDict([
+        ('nml.parse', (nml, Namelist.parse_file)),
+        ('nml.parse.regex', (nml, parse_file_regex)),
+        ('nml.read', (nml, lambda s: parameters._parse_file_nml(P, s))),
+        ('nml.write', (lambda: parameters._parse_file_nml(P, nml()), parameters._to_str_nml)),
+        ('nml.load', (lambda: _load_setup(size, workdir, False), _load)),
+        ('nml.load.cached', (lambda: _load_setup(size, workdir, True), _load)),
+        ('alex.read', (alex, lambda s: parameters._parse_file_alex(P, s))),
+        ('alex.write', (lambda: parameters._parse_file_alex(P, alex()), parameters._to_str_alex)),
+        ('alex.lookup', (lambda: _lookup_setup(size, workdir), _lookup)),
+        ('alex.lookup.lazy', (lambda: _lookup_setup(size, workdir), lambda data: _lookup(data, lazy=True))),
+        ('climber2.read', (climber2, lambda s: parameters._parse_file_climber2(P, s))),
+        ('climber2.write', (lambda: parameters._parse_file_climber2(P, climber2()), parameters._to_str_climber2)),
+        ('sweep.combiner', (lambda: (load_job(), sweep_args(members)), _sweep)),
+        ('sweep.table', (lambda: _table_setup(members), _table)),
+        ('sweep.write', (lambda: _write_setup(members // 10, workdir), _write)),
+        ('sweep.write.bulk', (lambda: _write_setup(members // 10, workdir), _write_bulk)),
+        ('sweep.makejob', (lambda: _makejob_setup(njobs, workdir), _makejobs)),
+    ])
+
+
+#
+# Baselines
+#
+def compare(results, baseline, tolerance=0.2):
+    " return the list of regressions of results with respect to the baseline "
+    regressions = []
+    for name, (t, rss) in results.iteritems():
+        if name not in baseline:
+            continue
+        t0, rss0 = baseline[name]
+        if t0 > 0 and t > t0 * (1 + tolerance):
+            regressions.append("{}: time {:.2f} ms -> {:.2f} ms (+{:.0%})".format(
+                name, t0*1e3, t*1e3, t/t0 - 1))
+        if rss > rss0 * (1 + tolerance) and rss - rss0 > 1024:
+            regressions.append("{}: peak memory +{} kB -> +{} kB".format(name, rss0, rss))
+    return regressions
+
+
+def main(argv=None):
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv)
+    size = int(args['--size'])
+    members = int(args['--members'])
+    njobs = int(args['--jobs'])
+    repeat = int(args['--repeat'])
+
+    # time the parsers: no cache of parsed files, but in the nml.load.cached stage
+    cache.DIRECTORY = "off"
+
+    print "Namelist.parse_file: {} groups x {} variables".format(size // 50, 50)
+    results = bench_parse_nml(max(1, size // 50), 50, repeat)
+    for k in results:
+        print "  {:<12} {:8.2f} ms".format(k, results[k]*1e3)
+    print "  speed-up     {:8.2f}x".format(results['regex']/results['tokenizer'])
+
+    print "Parameters.read_alex/read_climber2: examples/ files x 20"
+    results = bench_parse_values(repeat)
+    for k in results:
+        print "  {:<14} {:8.2f} ms".format(k, results[k]*1e3)
+    print "  speed-up       {:8.2f}x".format(results['eval']/results['parse_literal'])
+
+    print "Stages: {} parameters, sweep of {} members, {} jobs".format(size, members, njobs)
+    print "  {:<16} {:>10} {:>12}".format("stage", "time", "peak memory")
+    selected = args['--stages'].split(",") if args['--stages'] else None
+    results = OrderedDict()
+    workdir = tempfile.mkdtemp(prefix="bench")
+    try:
+        for name, (setup, func) in stages(size, members, njobs, workdir).iteritems():
+            if selected and not any(name == s or name.startswith(s+".") for s in selected):
+                continue
+            t, rss = measure(setup, func, repeat)
+            results[name] = (t, rss)
+            print "  {:<16} {:8.2f} ms {:+9d} kB".format(name, t*1e3, rss)
+    finally:
+        shutil.rmtree(workdir)
+
+    status = 0
+    if args['--compare']:
+        baseline = json.load(open(args['--compare']))
+        regressions = compare(results, baseline['stages'], float(args['--tolerance']))
+        if baseline.get('config') != dict(size=size, members=members, jobs=njobs):
+            print "Warning: baseline made with other sizes: {}".format(baseline.get('config'))
+        for r in regressions:
+            print "REGRESSION " + r
+        if not regressions:
+            print "No regression with respect to " + args['--compare']
+        status = 1 if regressions else 0
+
+    if args['--save']:
+        with open(args['--save'], 'w') as f:
+            json.dump(dict(config=dict(size=size, members=members, jobs=njobs),
+                           stages=results), f, indent=2)
+        print "Baseline saved to " + args['--save']
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+""" Persistent cache of parsed parameter files
+
+The default files (params.nml, control.nml, options_rembo, options_sico,
+run...) are parsed again by each job and each segment of a run, although
+they rarely change. load() keeps the parsed object of each file on disk
+(pickled), and returns it directly as long as the file is unchanged:
+
+    - the entry is used at once if the size, modification time and inode
+      of the file are those recorded with it
+    - otherwise the file is read, and the entry is still used if the SHA1
+      of its content is the same (e.g. the file was only touched)
+    - files modified less than RACY seconds before they were parsed are
+      always compared by content, since another change within the
+      resolution of the modification time would go unnoticed
+
+so that a cached object is never stale. The key of an entry also holds a
+fingerprint of the parsing code: the source of the module of the parse
+function, and of the parsers of this package (PARSERS), with the compiled
+code of the function itself, so that changing a parser parses the files
+again. Each call returns a new object, which can be modified freely.
+
+The entries are written to a temporary file then renamed, so that
+concurrent readers (e.g. the workers of job -j) only see complete
+entries, and an unreadable entry is simply parsed again. The total size
+of the cache is bounded: the least recently used entries are removed
+first.
+
+The cache directory is $RUN_CACHE (default: ~/.cache/run), and is
+disabled with RUN_CACHE=off. Its size is bounded by $RUN_CACHE_SIZE
+(in bytes, default: 64 MB).
+
+Usage:
+    cache.py [--clear]
+
+Examples
+--------
+>>> params = load("params.nml", "namelist", Namelist.parse_file)
+"""
+import cPickle as pickle
+import hashlib
+import marshal
+import tempfile
+import time
+import sys
+import os
+
+import instrument
+
+CACHE_ENV = 'RUN_CACHE'
+DIRECTORY = os.environ.get(CACHE_ENV, os.path.join(os.path.expanduser("~"), ".cache", "run"))
+MAXSIZE = int(os.environ.get('RUN_CACHE_SIZE', 64*1024*1024))
+RACY = 2.     # time (s) during which a file may change again without changing its mtime
+TOUCH = 60.   # entries are marked as recently used at most once in TOUCH seconds
+VERSION = 1   # format of the entries (part of their key)
+
+# modules used by all parse functions, part of the fingerprint of the code
+PARSERS = ("namelist.py", "parameters.py")
+
+def enabled():
+    return DIRECTORY not in ("", "off", "0")
+
+_sources = {} # path ==> SHA1 of the file
+
+def _source(path):
+    " SHA1 of a source file (read once per process), empty if it cannot be read "
+    if path not in _sources:
+        try:
+            with open(path, 'rb') as f:
+                _sources[path] = hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            _sources[path] = ""
+    return _sources[path]
+
+def _code(parse, depth=0):
+    """ fingerprint of the code of a parse function (or class): the source
+    of its module, and its compiled code with that of the functions it
+    closes over (e.g. a lambda calling the actual parser)
+    """
+    parts = []
+    module = sys.modules.get(getattr(parse, '__module__', None))
+    path = getattr(module, '__file__', None)
+    if path:
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        parts.append(_source(os.path.abspath(path)))
+    func = getattr(parse, 'im_func', parse)  # methods
+    code = getattr(func, 'func_code', None)
+    if code is not None:
+        parts.append(hashlib.sha1(marshal.dumps(code)).hexdigest())
+        for cell in func.func_closure or ():
+            if depth < 3 and callable(cell.cell_contents):
+                parts.append(_code(cell.cell_contents, depth+1))
+    return " ".join(parts)
+
+def _fingerprint(parse):
+    " fingerprint of the parsers of this package and of parse "
+    here = os.path.dirname(os.path.abspath(__file__))
+    return " ".join([_source(os.path.join(here, name)) for name in PARSERS] + [_code(parse)])
+
+def _entry(filename, kind, parse):
+    " cache file of the object of type kind parsed from filename by parse "
+    key = "{}\0{}\0{}\0{}\0{}".format(VERSION, sys.version_info[:2], kind, _fingerprint(parse),
+                                      os.path.abspath(filename))
+    return os.path.join(DIRECTORY, hashlib.sha1(key).hexdigest() + ".pkl")
+
+def _signature(st):
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def _read(filename):
+    with instrument.phase("read", file=filename):
+        with open(filename) as f:
+            text = f.read()
+    instrument.count("files_read")
+    instrument.count("bytes_read", len(text))
+    return text
+
+def _load(entry):
+    " (signature, digest, data) of an entry, or None "
+    try:
+        with open(entry, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None  # missing, partly evicted or from another version
+
+def _store(entry, signature, digest, data):
+    " write an entry atomically (errors are ignored: the cache is optional) "
+    try:
+        if not os.path.isdir(DIRECTORY):
+            os.makedirs(DIRECTORY)
+        fd, tmp = tempfile.mkstemp(dir=DIRECTORY, prefix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((signature, digest, data), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, entry)
+    except (IOError, OSError, pickle.PicklingError):
+        return
+    evict()
+
+def load(filename, kind, parse):
+    """ Return parse(text of filename), from the cache if the file did not
+    change since it was parsed (kind distinguishes the objects parsed
+    from the same file, e.g. the class and format)
+    """
+    if not enabled():
+        return parse(_read(filename))
+
+    st = os.stat(filename)
+    signature = _signature(st)
+    entry = _entry(filename, kind, parse)
+    cached = _load(entry)
+    if cached is not None and cached[0] == signature:
+        instrument.count("cache_hits")
+        _touch(entry)
+        return cached[2]
+
+    text = _read(filename)
+    digest = hashlib.sha1(text).hexdigest()
+    if cached is not None and cached[1] == digest:
+        instrument.count("cache_hits")
+        data = cached[2]
+    else:
+        instrument.count("cache_misses")
+        data = parse(text)
+
+    # a file modified just now may change again with the same signature
+    if time.time() - st.st_mtime < RACY:
+        signature = None
+    if cached is None or cached[:2] != (signature, digest):
+        _store(entry, signature, digest, data)
+    return data
+
+def _touch(entry):
+    " mark an entry as recently used (its modification time) "
+    try:
+        if time.time() - os.stat(entry).st_mtime > TOUCH:
+            os.utime(entry, None)
+    except OSError:
+        pass
+
+def entries():
+    " (modification time, size, path) of the entries, least recently used first "
+    found = []
+    try:
+        names = os.listdir(DIRECTORY)
+    except OSError:
+        return found
+    for name in names:
+        path = os.path.join(DIRECTORY, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue  # removed by another process
+        found.append((st.st_mtime, st.st_size, path))
+    return sorted(found)
+
+def evict(maxsize=None):
+    " remove the least recently used entries, down to 3/4 of maxsize if it is exceeded "
+    maxsize = MAXSIZE if maxsize is None else maxsize
+    found = entries()
+    total = sum(size for _, size, _ in found)
+    if total <= maxsize:
+        return
+    for _, size, path in found:
+        if total <= maxsize * 3 // 4:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def clear():
+    evict(0)
+
+
+def main(argv=None):
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv)
+    if args['--clear']:
+        clear()
+    found = entries()
+    print "{}: {} entries, {:.1f} kB (max {:.1f} kB)".format(
+        DIRECTORY, len(found), sum(size for _, size, _ in found)/1024., MAXSIZE/1024.)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+""" Preparation daemon: set up jobs without starting python each time
+
+Each call of job pays the start of the interpreter, the import of its
+modules and the reading of the default parameter files and exchange rules.
+The daemon pays it once: it keeps job loaded, with the default files
+(options_rembo, options_sico, run) and exchange rules of each directory it
+served in memory, and runs each request in a child process forked from it,
+which starts with all that state at once (copy-on-write).
+
+The client sends the arguments of job with its working directory and the
+environment variables used by job (ENVIRONMENT) over a Unix domain socket,
+and gets the output of job and its exit status back, so that
+
+    python daemon.py job -f -a output/test -p sico.x pdd_factor=0.5,1.0
+
+does the same as ./job with the same arguments. At most --jobs requests
+run at the same time (the others wait in the socket's queue). Files read
+in memory are read again if they changed (size, modification time or
+inode), so a request never sees stale defaults. The daemon does not read
+from the terminal: use -f (no confirmation), and not -e.
+
+The modules themselves are only loaded at start: restart the daemon after
+updating the code. The queue commands (LLSUBMIT, LLQ...) are taken from
+the environment of the client, the other module settings (e.g. RUN_CACHE)
+from that of the daemon.
+
+The daemon only serves its own user: the socket is created with mode 0600
+in $XDG_RUNTIME_DIR (or ~/.cache/run), the daemon checks the user of each
+client (on Linux), and the client checks that the socket belongs to its
+user before sending anything.
+
+Usage:
+    daemon.py [--socket=<path>] [--jobs=<n>] start
+    daemon.py [--socket=<path>] stop
+    daemon.py [--socket=<path>] job [<args>...]
+
+Options:
+    --socket=<path>     socket of the daemon (default: $RUN_DAEMON, or run-daemon.sock
+                        in $XDG_RUNTIME_DIR or ~/.cache/run)
+    --jobs=<n>          number of requests served at the same time [default: 4]
+
+Examples
+--------
+$ nohup python daemon.py start > daemon.log 2>&1 &
+$ python daemon.py job -f -a output/test -p sico.x pdd_factor=0.5,1.0
+$ python daemon.py stop
+"""
+import socket
+import struct
+import json
+import stat
+import sys
+import os
+
+SOCKET = os.environ.get('RUN_DAEMON') or os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser("~"), ".cache", "run"),
+    "run-daemon.sock")
+
+# executables whose default files and exchange rules are kept in memory (see job)
+EXECUTABLES = ("rembo.x", "sico.x", "sicoX.x", "climber.x")
+
+# module settings taken from the environment of the client: (module, attribute, variable)
+SETTINGS = (("job", "llsubmit", "LLSUBMIT"), ("job", "llcancel", "LLCANCEL"),
+            ("monitor", "LLQ", "LLQ"), ("monitor", "QSTAT", "QSTAT"))
+
+# environment variables of the client used by job (the others are the daemon's)
+ENVIRONMENT = ("USER", "RUN_TRACE", "RUN_CHECKSUM") + tuple(variable for _, _, variable in SETTINGS)
+
+# the output of a request is followed by NUL and its exit status
+_EXIT = "\0"
+
+#
+# Client
+#
+def _check_socket(sock):
+    " raise socket.error unless sock is a socket of the current user "
+    try:
+        st = os.stat(sock)
+    except OSError as error:
+        raise socket.error(str(error))
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise socket.error("{} is not a socket of the current user".format(sock))
+
+def request(message, sock=SOCKET, out=sys.stdout):
+    """ send a request to the daemon, copy its output to out as it comes,
+    and return the exit status
+    """
+    _check_socket(sock)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(sock)
+    client.sendall(json.dumps(message) + "\n")
+    client.shutdown(socket.SHUT_WR)
+    status = None
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        if status is None:
+            i = chunk.find(_EXIT)
+            if i < 0:
+                out.write(chunk)
+                out.flush()
+                continue
+            out.write(chunk[:i])
+            chunk, status = chunk[i+1:], ""
+        status += chunk
+    client.close()
+    return int(status) if status else 1  # no status: the request was interrupted
+
+def job(args, sock=SOCKET):
+    " run job with args in the daemon, from the current directory; returns the exit status "
+    env = dict((name, os.environ[name]) for name in ENVIRONMENT if name in os.environ)
+    return request(dict(args=args, cwd=os.getcwd(), env=env), sock)
+
+#
+# Daemon
+#
+_job = None
+_signatures = {}  # absolute path ==> signature of the file in memory
+
+def _load_job():
+    " import the job script as a module "
+    import imp
+    return imp.load_source("job", os.path.join(os.path.dirname(os.path.abspath(__file__)), "job"))
+
+def _changed(path):
+    """ True if the file changed since it was read in memory (or was never
+    read), None if it does not exist
+    """
+    import cache
+    import time
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = cache._signature(st)
+    if time.time() - st.st_mtime < cache.RACY:
+        signature = None  # may change again unnoticed: always read it again
+    changed = signature is None or _signatures.get(path) != signature
+    _signatures[path] = signature
+    return changed
+
+def warm(cwd):
+    """ read the default files and exchange rules of the directory cwd in
+    memory, or again if they changed since (see job.load_parameters and
+    exchange.read_rules)
+    """
+    import exchange
+    os.chdir(cwd)
+    for file in set(f for exe in EXECUTABLES for f in _job.default_files(exe)):
+        path = os.path.abspath(file)
+        if _changed(path) is not False:
+            _job.defaults.pop(path, None)
+            if os.path.isfile(path):
+                _read(_job.load_parameters, file)
+    for file in set(f for exe in EXECUTABLES for f in _job.exchange_files(exe)):
+        path = os.path.abspath(file)
+        if _changed(path) is not False:
+            for key in [k for k in exchange._rules if k[0] == path]:
+                del exchange._rules[key]
+            if os.path.isfile(path):
+                _read(exchange.read_rules, file)
+
+def _read(read, file):
+    " read a file in memory (errors are reported by the jobs, which read it again) "
+    try:
+        read(file)
+    except Exception:
+        pass
+
+def _serve(conn, message):
+    " run job in a child process, in the directory of the client and with its output to it "
+    import traceback
+    conn.setblocking(1)
+    fd = conn.fileno()
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.chdir(message['cwd'])
+    for name in ENVIRONMENT:
+        os.environ.pop(name, None)
+    env = message.get('env', {})
+    os.environ.update((name, env[name]) for name in ENVIRONMENT if name in env)
+    for module, name, variable in SETTINGS:
+        if variable in os.environ:
+            setattr(sys.modules[module], name, os.environ[variable])
+    sys.argv = ["job"] + message['args']
+    code = 0
+    try:
+        _job.main()
+    except SystemExit as e:
+        if isinstance(e.code, basestring):
+            print e.code
+        code = 1 if isinstance(e.code, basestring) else (e.code or 0)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.write(1, "{}{}\n".format(_EXIT, code))
+    os._exit(code)
+
+def _reap(children, block=False):
+    " forget the finished children (waiting for one if block) "
+    while children:
+        pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return
+        children.discard(pid)
+        block = False
+
+def _peer_uid(conn):
+    " user of the client of a connection (None if unknown: not Linux) "
+    if not sys.platform.startswith("linux"):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+def _listen(sock):
+    " socket of the daemon, readable and writable by its user only "
+    folder = os.path.dirname(os.path.abspath(sock))
+    if not os.path.isdir(folder):
+        os.makedirs(folder, 0700)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0177)
+    try:
+        server.bind(sock)
+    finally:
+        os.umask(umask)
+    os.chmod(sock, 0600)
+    return server
+
+def serve(sock=SOCKET, jobs=4):
+    " serve requests until a stop request "
+    global _job
+    _job = _load_job()
+    cwd = os.getcwd()
+
+    if os.path.exists(sock):
+        try:
+            request(dict(command="ping"), sock, out=open(os.devnull, 'w'))
+            raise SystemExit("daemon already running on " + sock)
+        except socket.error:
+            os.remove(sock)  # left by a daemon which did not stop
+    server = _listen(sock)
+    server.listen(128)
+    server.settimeout(1.)
+    print "Serving on {} ({} jobs at a time)".format(sock, jobs)
+    sys.stdout.flush()
+
+    children = set()
+    try:
+        while True:
+            _reap(children)
+            if len(children) >= jobs:
+                _reap(children, block=True)
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            if _peer_uid(conn) not in (None, os.getuid()):
+                conn.close()
+                continue
+            try:
+                conn.settimeout(10.)
+                message = json.loads(conn.makefile().readline())
+            except (ValueError, socket.error):
+                conn.close()
+                continue
+            command = message.get('command', 'job')
+            if command in ('stop', 'ping'):
+                conn.sendall("{}0\n".format(_EXIT))
+                conn.close()
+                if command == 'stop':
+                    break
+                continue
+            try:
+                warm(message['cwd'])
+            except OSError as error:
+                conn.sendall("Error: {}\n{}1\n".format(error, _EXIT))
+                conn.close()
+                continue
+            finally:
+                os.chdir(cwd)
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                try:
+                    _serve(conn, message)
+                finally:
+                    os._exit(1)  # e.g. the client left: never run the cleanup of the daemon
+            children.add(pid)
+            conn.close()
+    finally:
+        server.close()
+        os.remove(sock)
+        _reap(children, block=True)
+    print "Stopped"
+
+
+def main(argv=None):
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv, options_first=True)
+    sock = args['--socket'] or SOCKET
+    if args['start']:
+        serve(sock, int(args['--jobs']))
+        return 0
+    try:
+        if args['stop']:
+            return request(dict(command="stop"), sock)
+        return job(args['<args>'], sock)
+    except socket.error as error:
+        print "No daemon on {} ({}), start it with: python daemon.py start".format(sock, error)
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
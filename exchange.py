@@ -0,0 +1,191 @@
+""" Exchange of parameter values between modules (e.g. REMBO ==> SICOPOLIS)
+
+The exchange files (param_exchange.txt...) list one rule per line:
+
+    source : target = conversion
+
+The conversion is one of:
+    1                   the value is copied as is (e.g. strings, logicals)
+    0.001               a factor
+    1.8*x + 32          an affine function of the source value x
+    (x - 32) / 1.8      (any expression of x with + - * / and numbers
+                         which is affine)
+    mm/day -> m/yr      a conversion between units (see UNITS)
+
+Lines starting with the comment character are skipped, as well as
+comments at the end of a rule.
+
+Each file is parsed only once (see read_rules), into rules which only
+hold a scale and an offset, so that applying them to the members of a
+batch only costs a multiplication and an addition per rule. Converted
+values are passed on as numbers, and only formatted (see format_value)
+when they are written to a parameter file.
+
+Examples
+--------
+>>> rules = read_rules("param_exchange.txt")
+>>> for name, value in rules.values(lambda name: p_rembo.get(name).value):
+...     p_sico.set(name=name, value=value)
+"""
+import ast
+import re
+import os
+
+import instrument
+
+# Units: name ==> (scale, offset) to convert to SI units
+# (a year is 365.25 days, as in the models)
+YEAR = 365.25*86400.
+UNITS = {
+    '1': (1., 0.), '%': (0.01, 0.),
+    'm': (1., 0.), 'km': (1e3, 0.), 'cm': (1e-2, 0.), 'mm': (1e-3, 0.),
+    's': (1., 0.), 'min': (60., 0.), 'h': (3600., 0.), 'hr': (3600., 0.),
+    'day': (86400., 0.), 'days': (86400., 0.), 'd': (86400., 0.),
+    'a': (YEAR, 0.), 'yr': (YEAR, 0.), 'years': (YEAR, 0.), 'kyr': (1e3*YEAR, 0.),
+    'kg': (1., 0.), 'g': (1e-3, 0.), 't': (1e3, 0.), 'Gt': (1e12, 0.),
+    'Pa': (1., 0.), 'kPa': (1e3, 0.), 'MPa': (1e6, 0.), 'bar': (1e5, 0.),
+    'W': (1., 0.), 'kW': (1e3, 0.), 'J': (1., 0.), 'kJ': (1e3, 0.),
+    # temperatures: with an offset, only valid on their own
+    'K': (1., 0.), 'degC': (1., 273.15), 'C': (1., 273.15), 'degF': (5/9., 273.15-32*5/9.),
+}
+
+class Rule(object):
+    " one exchange: target = scale*source + offset (or a copy if scale is None) "
+    __slots__ = ('source', 'target', 'scale', 'offset', 'conversion')
+
+    def __init__(self, source, target, conversion="1"):
+        self.source = source
+        self.target = target
+        self.conversion = conversion
+        self.scale, self.offset = compile_conversion(conversion)
+
+    def __call__(self, value):
+        if self.scale is None:
+            return value
+        return self.scale*to_number(value) + self.offset
+
+    def __repr__(self):
+        return "{} : {} = {}".format(self.source, self.target, self.conversion)
+
+class Rules(list):
+    " the rules of an exchange file, in file order "
+
+    def values(self, get):
+        """ Iterate over (target name, converted value) for all rules,
+        with get(name) returning the value of a source parameter
+        """
+        for rule in self:
+            yield rule.target, rule(get(rule.source))
+
+def to_number(value):
+    " numeric value of a parameter (float, or a string such as 1.d-3) "
+    if isinstance(value, (int, long, float)):
+        return value
+    return float(value.strip().replace('d', 'e').replace('D', 'e'))
+
+def format_value(value):
+    """ Format a converted value for a parameter file: 15 significant
+    digits, so that converted values are not rounded (e.g. 1000, 0.3, 1e-05)
+    """
+    if isinstance(value, float):
+        return "%.15g" % value
+    return str(value)
+
+_number = re.compile(r"^[-+]?(\d+\.?\d*|\.\d+)([eEdD][-+]?\d+)?$")
+
+def compile_conversion(conversion):
+    """ Return (scale, offset) of a conversion (see module doc),
+    scale is None for a plain copy
+    """
+    conversion = conversion.strip()
+    if conversion == "1":
+        return None, 0.
+    if _number.match(conversion):
+        return to_number(conversion), 0.
+    if "->" in conversion:
+        return _convert_units(*conversion.split("->"))
+    return _affine(conversion)
+
+def _affine_node(node):
+    """ (scale, offset) of an expression of x, with numbers and + - * /
+    (ValueError if it is not affine)
+    """
+    if isinstance(node, ast.Expression):
+        return _affine_node(node.body)
+    if isinstance(node, ast.Num):
+        return 0., float(node.n)
+    if isinstance(node, ast.Name) and node.id == 'x':
+        return 1., 0.
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        a, b = _affine_node(node.operand)
+        return (-a, -b) if isinstance(node.op, ast.USub) else (a, b)
+    if isinstance(node, ast.BinOp):
+        a1, b1 = _affine_node(node.left)
+        a2, b2 = _affine_node(node.right)
+        if isinstance(node.op, ast.Add):
+            return a1+a2, b1+b2
+        if isinstance(node.op, ast.Sub):
+            return a1-a2, b1-b2
+        if isinstance(node.op, ast.Mult) and (a1 == 0 or a2 == 0):
+            return a1*b2 + a2*b1, b1*b2
+        if isinstance(node.op, ast.Div) and a2 == 0:
+            return a1/b2, b1/b2
+        raise ValueError("not affine")
+    raise ValueError("not allowed in a conversion: "+ast.dump(node))
+
+def _affine(expression):
+    " (scale, offset) of an affine expression of x "
+    try:
+        return _affine_node(ast.parse(expression, mode='eval'))
+    except (SyntaxError, ValueError, ZeroDivisionError) as error:
+        raise ValueError("invalid conversion: {} ({})".format(expression, error))
+
+def _unit(unit):
+    " (scale, offset) of a unit such as m, m/yr, kg/m2, W m-2 "
+    unit = unit.strip()
+    if unit in UNITS:
+        return UNITS[unit]
+    scale = 1.
+    for sign, factor in re.findall(r"(^|[/*\s])\s*([^/*\s]+)", unit):
+        m = re.match(r"^([a-zA-Z%]+|1)\^?(-?\d+)?$", factor)
+        if m is None or m.group(1) not in UNITS:
+            raise ValueError("unknown unit: "+factor)
+        s, offset = UNITS[m.group(1)]
+        if offset:
+            raise ValueError("units with an offset cannot be combined: "+unit)
+        power = int(m.group(2) or 1)
+        if sign == "/": power = -power
+        scale *= s**power
+    return scale, 0.
+
+def _convert_units(source, target):
+    " (scale, offset) converting from the source to the target unit "
+    s1, o1 = _unit(source)
+    s2, o2 = _unit(target)
+    return s1/s2, (o1-o2)/s2
+
+# Rules of the exchange files, read only once per batch
+_rules = {}
+
+def read_rules(file, comment="#", sep=":"):
+    " return the rules of an exchange file, parsed only the first time "
+    key = (os.path.abspath(file), comment, sep)
+    if key in _rules:
+        return _rules[key]
+
+    with instrument.phase("exchange.read", file=file):
+        lines = open(file, 'r').readlines()
+    instrument.count("files_read")
+
+    rules = Rules()
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] == comment or not sep in line:
+            continue
+        line = line.split(comment)[0]
+        names, _, conversion = line.partition("=")
+        source, _, target = names.partition(sep)
+        rules.append(Rule(source.strip(), target.strip(), conversion))
+
+    _rules[key] = rules
+    return rules
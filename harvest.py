@@ -0,0 +1,327 @@
+""" Harvest metrics from the logs of the runs of a batch
+
+The runs listed in the 'batch' file of an output directory (see job) write
+their output to out.out and out.err in their folder. The folders are
+relative to the directory job was run from (the parent of output/ or
+outtmp/), so that harvest.py can be run from anywhere. harvest() extracts
+metrics from these logs with regular expressions, e.g. the last model year
+reached, the last error message or NaNs, and writes them to a single
+summary file in the output directory (harvest.json), column by column:
+
+    {"metrics": {name: [mode, pattern]},
+     "columns": {"run": [...], "signature": [...], "year": [...], ...}}
+
+The logs are memory-mapped and searched from their end, one block at a
+time, so that the last value of a metric is found without reading a long
+log (the metrics are assumed to fit on one line). The modes are:
+
+    last    value of the last match: the first group of the pattern, or
+            the line of the match if it has no group (as a number if possible)
+    any     True if the pattern is found
+    count   number of matches (the whole log is searched)
+
+Runs whose logs did not change since the last harvest (size, modification
+time and inode) keep their values, so that harvesting a batch again only
+reads the logs of the runs which went on or were added. The logs are
+searched by a pool of processes.
+
+The metrics are read from a file (--metrics), one per line:
+
+    name mode = pattern
+
+Usage:
+    harvest.py [--jobs=<n>] [--metrics=<file>] [--output=<file>] [--full] [--show] <outdir>...
+
+Options:
+    --jobs=<n>          number of processes (default: number of cores)
+    --metrics=<file>    file of the metrics (default: see METRICS)
+    --output=<file>     summary file, in each output directory [default: harvest.json]
+    --full              harvest all runs again
+    --show              print the metrics of each run
+
+Examples
+--------
+>>> columns = harvest("output/runs/")
+>>> [run for run, nan in zip(columns['run'], columns['nan']) if nan]
+"""
+from collections import OrderedDict
+import multiprocessing
+import mmap
+import json
+import sys
+import re
+import os
+
+import instrument
+
+SUMMARY_FILE = 'harvest.json'
+LOGS = ("out.out", "out.err")
+MODES = ("last", "any", "count")
+BLOCK = 1 << 12     # size of the first block searched from the end of the logs,
+MAXBLOCK = 1 << 20  # doubled up to this size for each block further from the end
+
+# Default metrics: name ==> (mode, pattern)
+METRICS = OrderedDict([
+    ('year', ('last', r"(?i)\byear\s*[=:]?\s*([-+]?\d+(?:\.\d*)?)")),
+    ('error', ('last', r"(?i)error|severe|abort|segmentation fault|killed|time limit")),
+    ('nan', ('any', r"(?i)\bnan\b")),
+    ('cpu_time', ('last', r"(?i)\b(?:cpu|wall|elapsed) ?time\s*[=:]?\s*([\d.]+)")),
+])
+
+def read_metrics(filename):
+    " metrics of a file, one per line: name mode = pattern "
+    metrics = OrderedDict()
+    with open(filename) as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            names, _, pattern = line.partition("=")
+            name, mode = (names.split() + ["last"])[:2]
+            if mode not in MODES:
+                raise ValueError("unknown mode {} of metric {} (one of {})".format(mode, name, ", ".join(MODES)))
+            re.compile(pattern.strip())
+            metrics[name] = (mode, pattern.strip())
+    return metrics
+
+def job_directory(outdir):
+    """ directory job was run from for an output directory: the parent of
+    its output/ or outtmp/ folder (or the working directory)
+    """
+    parts = os.path.abspath(outdir).split(os.sep)
+    for i in range(len(parts)-1, 0, -1):
+        if parts[i] in ("output", "outtmp"):
+            return os.sep.join(parts[:i]) or os.sep
+    return os.getcwd()
+
+def read_batch(outdir):
+    """ run folders listed in the batch file of an output directory, once
+    each and in order, relative to the job directory (job lists them without
+    the output/ or outtmp/ prefix, and again when a batch is issued again)
+    """
+    folders = []
+    filename = os.path.join(outdir, "batch")
+    if not os.path.isfile(filename):
+        return folders
+    jobdir = job_directory(outdir)
+    seen = set()
+    with open(filename) as f:
+        for entry in f.read().split():
+            for folder in (entry, "output/"+entry, "outtmp/"+entry):
+                if os.path.isdir(os.path.join(jobdir, folder)):
+                    break
+            else:
+                folder = entry
+            if folder not in seen:
+                seen.add(folder)
+                folders.append(folder)
+    return folders
+
+#
+# Search of the logs
+#
+def _value(buf, m):
+    " value of a match: its first group, or the line of the match, as a number if possible "
+    if m.re.groups:
+        text = m.group(1)
+    else:
+        end = buf.find("\n", m.end())
+        text = buf[buf.rfind("\n", 0, m.start())+1:end if end >= 0 else len(buf)]
+    text = text.strip()
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+def _last(buf, regex):
+    " last match of regex in buf, searched from the end one block of lines at a time "
+    end = len(buf)
+    block = BLOCK
+    while end > 0:
+        start = max(0, end - block)
+        block = min(2*block, MAXBLOCK)
+        if start > 0:
+            # start the block on a line, the rest is searched with the previous block
+            start = buf.find("\n", start, end) + 1 or start
+        last = None
+        for last in regex.finditer(buf, start, end):
+            pass
+        if last is not None:
+            return last
+        end = start
+    return None
+
+def search(filename, metrics):
+    """ values of the metrics in a log (None if not found)
+    metrics: name ==> (mode, compiled pattern)
+    """
+    values = dict.fromkeys(metrics)
+    size = os.path.getsize(filename)
+    if size == 0:
+        return values
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for name, (mode, regex) in metrics.iteritems():
+            if mode == "count":
+                values[name] = sum(1 for _ in regex.finditer(buf))
+                instrument.count("bytes_read", size)
+            else:
+                m = _last(buf, regex)
+                if m is not None:
+                    values[name] = True if mode == "any" else _value(buf, m)
+    finally:
+        buf.close()
+    instrument.count("files_read")
+    return values
+
+def signature(folder):
+    " size, modification time and inode of the logs of a run (None if missing) "
+    sig = []
+    for log in LOGS:
+        try:
+            st = os.stat(os.path.join(folder, log))
+            sig.append([st.st_size, st.st_mtime, st.st_ino])
+        except OSError:
+            sig.append(None)
+    return sig
+
+_compiled = {}
+
+def _compile(metrics):
+    key = tuple((name, tuple(spec)) for name, spec in metrics.iteritems())
+    if key not in _compiled:
+        _compiled[key] = OrderedDict((name, (mode, re.compile(pattern, re.M)))
+                                     for name, (mode, pattern) in metrics.iteritems())
+    return _compiled[key]
+
+def harvest_run(folder, metrics):
+    """ values of the metrics of a run, over its logs: the last value found
+    in any log, or the total count
+    metrics: name ==> (mode, pattern)
+    """
+    compiled = _compile(metrics)
+    values = OrderedDict((name, 0 if mode == "count" else None) for name, (mode, _) in metrics.iteritems())
+    for log in LOGS:
+        filename = os.path.join(folder, log)
+        if not os.path.isfile(filename):
+            continue
+        found = search(filename, compiled)
+        for name, (mode, _) in metrics.iteritems():
+            if mode == "count":
+                values[name] += found[name] or 0
+            elif found[name] is not None and values[name] is None:
+                values[name] = found[name]  # out.out is searched first
+    return values
+
+def _harvest_run(args):
+    folder, metrics = args
+    return harvest_run(folder, metrics)
+
+#
+# Summary
+#
+def read_summary(filename):
+    " the summary file: {'metrics': ..., 'columns': ...}, or None "
+    try:
+        with open(filename) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return None
+
+def write_summary(filename, metrics, columns):
+    " write the summary file (atomic write) "
+    with open(filename+'.tmp', 'w') as f:
+        json.dump(OrderedDict([('metrics', metrics), ('columns', columns)]), f)
+    os.rename(filename+'.tmp', filename)
+
+def harvest(outdir, metrics=None, output=SUMMARY_FILE, nproc=None, full=False):
+    """ harvest the metrics of the runs of an output directory, write them
+    to its summary file, and return the columns: name ==> list of values
+    (with 'run' and 'signature')
+    """
+    metrics = metrics or METRICS
+    metrics = OrderedDict((name, list(spec)) for name, spec in metrics.iteritems())
+    filename = os.path.join(outdir, output)
+    folders = read_batch(outdir)
+    jobdir = job_directory(outdir)
+    path = dict((folder, os.path.join(jobdir, folder)) for folder in folders)
+
+    # values of the runs whose logs did not change (unless the metrics did)
+    previous = {}
+    old = None if full else read_summary(filename)
+    if old is not None and old['metrics'] == metrics:
+        columns = old['columns']
+        for i, folder in enumerate(columns['run']):
+            previous[folder] = (columns['signature'][i], [columns[name][i] for name in metrics])
+
+    signatures = [signature(path[folder]) for folder in folders]
+    todo = [folder for folder, sig in zip(folders, signatures)
+            if folder not in previous or previous[folder][0] != sig]
+
+    with instrument.phase("harvest", runs=len(todo)):
+        if len(todo) > 1 and nproc != 1:
+            pool = multiprocessing.Pool(nproc)
+            try:
+                found = pool.map(_harvest_run, [(path[folder], metrics) for folder in todo],
+                                 chunksize=max(1, len(todo) // (4*(nproc or multiprocessing.cpu_count()))))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            found = [harvest_run(path[folder], metrics) for folder in todo]
+    found = dict(zip(todo, found))
+
+    columns = OrderedDict([('run', folders), ('signature', signatures)])
+    for name in metrics:
+        columns[name] = []
+    for folder in folders:
+        if folder in found:
+            values = found[folder].values()
+        else:
+            values = previous[folder][1]
+        for name, value in zip(metrics, values):
+            columns[name].append(value)
+
+    write_summary(filename, metrics, columns)
+    return columns
+
+def show(columns, out=None):
+    " print the metrics of each run "
+    out = out or sys.stdout
+    names = [name for name in columns if name not in ('run', 'signature')]
+    width = max([len(run) for run in columns['run']] + [3])
+    out.write("{:<{}} {}\n".format("run", width, " ".join("{:>12}".format(name) for name in names)))
+    for i, run in enumerate(columns['run']):
+        values = [columns[name][i] for name in names]
+        out.write("{:<{}} {}\n".format(run, width, " ".join("{:>12}".format(_short(v)) for v in values)))
+
+def _found(mode, value):
+    " True if a metric was found in the logs of a run "
+    return value > 0 if mode == "count" else value not in (None, False)
+
+def _short(value):
+    if value is None:
+        return "-"
+    if isinstance(value, basestring) and len(value) > 12:
+        return value[:11] + "~"
+    return str(value)
+
+
+def main(argv=None):
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv)
+    metrics = read_metrics(args['--metrics']) if args['--metrics'] else METRICS
+    nproc = int(args['--jobs']) if args['--jobs'] else None
+    for outdir in args['<outdir>']:
+        n = len(read_batch(outdir))
+        columns = harvest(outdir, metrics, args['--output'], nproc, args['--full'])
+        if args['--show']:
+            show(columns)
+        found = dict((name, sum(1 for v in columns[name] if _found(metrics[name][0], v))) for name in metrics)
+        print "{}: {} runs, {} -> {}".format(outdir, n, ", ".join("{} {}".format(found[name], name) for name in metrics),
+                                             os.path.join(outdir, args['--output']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+""" Lightweight instrumentation: wall time of phases, and counters
+
+Disabled by default, with almost no overhead (phase() returns a shared
+no-op context manager, count() returns immediately). Enabled by setting
+the RUN_TRACE environment variable to a trace file name, or by calling
+start(filename), which also passes it on to child processes.
+
+Events are written to the trace file in the Chrome trace format (JSON
+array, open in chrome://tracing or https://ui.perfetto.dev): one complete
+event per phase, and the counters of each process (files read, bytes
+written, subprocesses spawned...). Each process appends its events when
+its outermost phase ends, so that processes of a batch (e.g. job -j
+workers, or runs started by it) share one file. The appends are made
+under a lock, before the closing bracket of the array, so that the file
+is valid JSON at any time (e.g. for json.load).
+
+Examples
+--------
+>>> start("trace.json")
+>>> with phase("read", file="options_rembo"):
+...     count("files_read")
+>>> report()
+"""
+from collections import defaultdict
+from functools import wraps
+import atexit
+import fcntl
+import json
+import time
+import sys
+import os
+
+TRACE_ENV = 'RUN_TRACE'
+
+_enabled = False
+_trace_file = None
+_events = []
+_counters = defaultdict(int)
+_depth = [0]
+_pid = [None]
+
+class _NoPhase(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_nophase = _NoPhase()
+
+class _Phase(object):
+    __slots__ = ('name', 'args', 't0')
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+    def __enter__(self):
+        if _pid[0] != os.getpid():
+            _forked()
+        _depth[0] += 1
+        self.t0 = time.time()
+        return self
+    def __exit__(self, *exc):
+        t1 = time.time()
+        event = dict(name=self.name, ph='X', ts=int(self.t0*1e6), dur=int((t1-self.t0)*1e6),
+                     pid=os.getpid(), tid=0)
+        if self.args:
+            event['args'] = self.args
+        _events.append(event)
+        _depth[0] -= 1
+        if _depth[0] == 0:
+            flush()
+        return False
+
+def _forked():
+    " in a child process forked by a traced one: start with empty records "
+    _pid[0] = os.getpid()
+    _depth[0] = 0
+    del _events[:]
+    _counters.clear()
+
+def phase(name, **args):
+    " context manager recording the wall time of a phase (args are stored with it) "
+    if not _enabled:
+        return _nophase
+    return _Phase(name, args)
+
+def record(name, t0, t1, **args):
+    " record a phase which started at time t0 and ended at t1 (e.g. a background process) "
+    if not _enabled:
+        return
+    if _pid[0] != os.getpid():
+        _forked()
+    _events.append(dict(name=name, ph='X', ts=int(t0*1e6), dur=int((t1-t0)*1e6),
+                        pid=os.getpid(), tid=1, args=args))
+    if _depth[0] == 0:
+        flush()
+
+def count(name, n=1):
+    " increment a counter "
+    if _enabled:
+        if _pid[0] != os.getpid():
+            _forked()
+        _counters[name] += n
+
+def timed(name=None):
+    " decorator: record each call of the function as a phase "
+    def decorator(func):
+        label = name or func.__name__
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Phase(label, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def enabled():
+    return _enabled
+
+def enable(filename):
+    " record events to filename (appended to the events of other processes) "
+    global _enabled, _trace_file
+    _enabled = True
+    _trace_file = filename
+    _forked()
+
+def start(filename):
+    " start a new trace file, also used by the child processes "
+    with open(filename, 'w') as f:
+        f.write("[\n]\n")
+    os.environ[TRACE_ENV] = filename
+    enable(filename)
+
+def flush():
+    " append the events of this process, and its counters, to the trace file "
+    if not _enabled or not (_events or _counters) or _pid[0] != os.getpid():
+        return
+    ts = int(time.time()*1e6)
+    events = list(_events)
+    if _counters:
+        events.append(dict(name='counters', ph='C', ts=ts, pid=os.getpid(), tid=0, args=dict(_counters)))
+    del _events[:]
+    text = ",\n".join(json.dumps(e) for e in events) + "\n]\n"
+    fd = os.open(_trace_file, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        # the processes of a batch append one at a time
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        end = os.fstat(fd).st_size
+        if end == 0:
+            text = "[\n" + text # new trace (not started by start())
+        else:
+            # write over the closing bracket, after the events already there
+            os.lseek(fd, max(0, end-64), os.SEEK_SET)
+            tail = os.read(fd, 64).rstrip()
+            if tail.endswith("]"):
+                tail = tail[:-1].rstrip()
+            end = end - 64 + len(tail) if end > 64 else len(tail)
+            text = ("\n" if tail.endswith(("[", ",")) else ",\n") + text
+        os.ftruncate(fd, end)
+        os.lseek(fd, end, os.SEEK_SET)
+        os.write(fd, text)
+    finally:
+        os.close(fd)  # also releases the lock
+
+def read_trace(filename):
+    " return the list of events of a trace file (also while it is written) "
+    text = open(filename).read().strip()
+    if not text.startswith("["):
+        text = "[" + text
+    if text.endswith(","):
+        text = text[:-1]
+    if not text.endswith("]"):
+        text += "]"
+    return json.loads(text)
+
+def summary(events):
+    """ aggregate the events of a trace:
+    phases: name ==> [calls, total time in s, max time in s]
+    counters: name ==> total over all processes (last value of each process)
+    """
+    phases = {}
+    last = {}
+    for e in events:
+        if e['ph'] == 'X':
+            p = phases.setdefault(e['name'], [0, 0., 0.])
+            p[0] += 1
+            p[1] += e['dur']*1e-6
+            p[2] = max(p[2], e['dur']*1e-6)
+        elif e['ph'] == 'C':
+            last[e['pid']] = e['args']
+    counters = defaultdict(int)
+    for args in last.itervalues():
+        for k, v in args.iteritems():
+            counters[k] += v
+    return phases, dict(counters)
+
+def report(filename=None, out=sys.stdout):
+    " print the summary of the trace file (default: the current one) "
+    flush()
+    filename = filename or _trace_file
+    phases, counters = summary(read_trace(filename))
+    out.write("Timing summary ({}):\n".format(filename))
+    out.write("  {:<24} {:>7} {:>11} {:>11}\n".format("phase", "calls", "total (ms)", "max (ms)"))
+    for name in sorted(phases, key=lambda k: -phases[k][1]):
+        n, total, tmax = phases[name]
+        out.write("  {:<24} {:>7} {:>11.1f} {:>11.1f}\n".format(name, n, total*1e3, tmax*1e3))
+    for name in sorted(counters):
+        out.write("  {:<24} {:>7}\n".format(name, counters[name]))
+
+# enabled by the environment, e.g. in a process started by a traced batch
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
+
+atexit.register(flush)
+
+if __name__ == "__main__":
+    # print the summary of a trace file
+    report(sys.argv[1] if len(sys.argv) > 1 else os.environ.get(TRACE_ENV, 'trace.json'))
@@ -0,0 +1,348 @@
+""" Queue monitor for batches submitted to LoadLeveler (llsubmit) or SGE (qsub)
+
+Instead of listing the queue after each submission, the job ids are
+recorded in the file 'queue.jobs' of the batch folder as the jobs are
+submitted (one JSON record per line), and the queue is listed once per
+poll for the whole batch (one llq or qstat call per queue system).
+
+The state of each member is then kept in the file 'queue.status':
+    submitted : just submitted, not listed in the queue yet
+    queued    : waiting in the queue
+    running   : running
+    done      : left the queue, with exit code 0 in the run cache, or
+                no failure message at the end of its out.err
+    failed    : left the queue, with another exit code, or a failure
+                message at the end of out.err (see FAILURES)
+    lost      : never seen in the queue, and no output (e.g. rejected)
+
+The first line of 'queue.status' holds the counts by state and the time
+of the last poll, so that the status of a batch is read at once, whatever
+its size (see summary). Changes of state are also recorded in the run
+registry, if given.
+
+The failure messages are patterns searched in the last TAIL bytes of
+out.err, e.g. of the Fortran runtime or the queue. Other ones can be read
+from a file (--failures), one pattern per line.
+
+Usage:
+    monitor.py [--interval=<s>] [--once] [--registry=<db>] [--failures=<file>] <batch>...
+
+Options:
+    --interval=<s>      time between two polls of the queue [default: 60]
+    --once              poll the queue once and exit
+    --registry=<db>     update the status of the runs in this registry
+    --failures=<file>   file of the failure messages (default: see FAILURES)
+
+Examples
+--------
+>>> record("output/batch/", "output/batch/run1/", "iplex01.1234.0", queue="ll")
+>>> poll("output/batch/")
+>>> summary("output/batch/")
+{'updated': 1400000000.0, 'counts': {'queued': 1}}
+"""
+from collections import OrderedDict
+import subprocess
+import json
+import time
+import re
+import os
+
+import instrument
+import scheduler
+import registry
+
+JOBS_FILE = 'queue.jobs'
+STATUS_FILE = 'queue.status'
+
+# Queue listing commands (can be replaced via environment variables, e.g. for testing)
+LLQ = os.environ.get('LLQ', '/opt/ibmll/LoadL/full/bin/llq')
+QSTAT = os.environ.get('QSTAT', 'qstat')
+
+STATES = ('submitted', 'queued', 'running', 'done', 'failed', 'lost')
+GRACE = 300  # time (s) during which a submitted job may not be listed yet
+
+# messages in out.err which make a job failed
+FAILURES = [
+    r"^forrtl: severe",                         # Fortran runtime (ifort)
+    r"^Program received signal",                # Fortran runtime (gfortran)
+    r"(?i)segmentation fault|\bSIGSEGV\b",
+    r"(?i)\bcore dumped\b",
+    r"(?:^|\d+ )Killed\b",                      # killed by the system or the queue
+    r"(?i)cpu time limit exceeded",             # queue limits
+    r"(?i)wall ?clock limit",
+]
+TAIL = 1 << 16  # size (bytes) of the end of out.err searched for them
+
+# Queue states ==> member state (other states: the job is leaving the queue)
+_LL_STATES = {'I': 'queued', 'NQ': 'queued', 'H': 'queued', 'S': 'queued', 'HS': 'queued', 'D': 'queued',
+              'V': 'queued', 'R': 'running', 'ST': 'running', 'P': 'running', 'CK': 'running', 'E': 'running',
+              'EP': 'running', 'MP': 'running'}
+_SGE_STATES = {'qw': 'queued', 'hqw': 'queued', 'hRwq': 'queued', 'h': 'queued', 'w': 'queued',
+               'r': 'running', 't': 'running', 'Rr': 'running', 'Rt': 'running', 's': 'running',
+               'S': 'running', 'T': 'running', 'Eqw': 'failed'}
+
+#
+# Submission
+#
+def parse_submit(output):
+    """ job id from the output of llsubmit or qsub (None if not submitted):
+    NUMBER for a job, or the job of an array (whose members are NUMBER.STEP)
+    """
+    # llsubmit: The job "iplex01.pik-potsdam.de.123456" has been submitted.
+    # (multi-step jobs: The job "iplex01.pik-potsdam.de.123456" with 3 job steps has been submitted.)
+    m = re.search(r'job "?[\w.-]*?\.?(\d+)"?(?: with \d+ job steps?)? has been submitted', output)
+    if m is None:
+        # qsub: Your job 12345 ("job.submit") / Your job-array 12345.1-10:1 ("job.submit")
+        m = re.search(r'Your job(?:-array)? (\d+)', output)
+    return m.group(1) if m else None
+
+def record(batch, folder, job, queue="ll"):
+    """ record the submission of a member: folder, queue job id (NUMBER.STEP
+    for LoadLeveler, NUMBER or NUMBER.TASK for SGE) and queue system ("ll" or "sge")
+    """
+    with open(os.path.join(batch, JOBS_FILE), 'a') as f:
+        f.write(json.dumps(dict(run=folder, job=job, queue=queue, submitted=time.time()))+"\n")
+
+def read_jobs(batch):
+    " submission record of each member: folder ==> record (the last submission) "
+    jobs = OrderedDict()
+    filename = os.path.join(batch, JOBS_FILE)
+    if not os.path.isfile(filename):
+        return jobs
+    with open(filename) as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            jobs.pop(r['run'], None)
+            jobs[r['run']] = r
+    return jobs
+
+#
+# Queue listings
+#
+def parse_llq(text):
+    " state of each job step listed by llq: NUMBER.STEP ==> state code "
+    jobs = {}
+    for line in text.splitlines():
+        tokens = line.split()
+        if len(tokens) < 5:
+            continue
+        m = re.match(r'^\S*?(\d+)\.(\d+)$', tokens[0])
+        if m is None:
+            continue
+        jobs["{}.{}".format(*m.groups())] = tokens[4]
+    return jobs
+
+def _tasks(spec):
+    " task ids of an SGE ja-task-ID column: 3, 1-10:1, 2,4 "
+    tasks = []
+    for part in spec.split(","):
+        m = re.match(r'^(\d+)(?:-(\d+)(?::(\d+))?)?$', part)
+        if m is None:
+            continue
+        first = int(m.group(1))
+        last = int(m.group(2) or first)
+        tasks.extend(range(first, last+1, int(m.group(3) or 1)))
+    return tasks
+
+def parse_qstat(text):
+    " state of each job (or array task) listed by qstat: NUMBER or NUMBER.TASK ==> state code "
+    jobs = {}
+    for line in text.splitlines():
+        tokens = line.split()
+        if len(tokens) < 8 or not tokens[0].isdigit():
+            continue
+        number, code = tokens[0], tokens[4]
+        rest = [t for t in tokens[7:] if "@" not in t]  # [queue], slots, [tasks]
+        if len(rest) >= 2:
+            for task in _tasks(rest[1]):
+                jobs["{}.{}".format(number, task)] = code
+        else:
+            jobs[number] = code
+    return jobs
+
+def list_queue(queue, user=None):
+    """ list the jobs of user in the queue ("ll" or "sge"): job id ==> member state
+    (queued or running, other jobs are leaving the queue), or None if the
+    queue could not be listed
+    """
+    user = user or os.environ.get('USER')
+    if queue == "sge":
+        cmd, parse, states = [QSTAT, '-u', user], parse_qstat, _SGE_STATES
+    else:
+        cmd, parse, states = [LLQ, '-u', user], parse_llq, _LL_STATES
+    instrument.count("subprocesses")
+    with instrument.phase("queue.list", queue=queue):
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+        except OSError:
+            return None
+    # llq exits with 1 if there is no job
+    if proc.returncode != 0 and not "currently no job" in out + err:
+        return None
+    return dict((job, states.get(code)) for job, code in parse(out).iteritems())
+
+#
+# Member states
+#
+def read_failures(filename):
+    " failure messages of a file, one pattern per line "
+    failures = []
+    with open(filename) as f:
+        for line in f:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            re.compile(pattern)
+            failures.append(pattern)
+    return failures
+
+_compiled = {}
+
+def _compile(failures):
+    " one regular expression for all failure messages "
+    key = tuple(failures)
+    if key not in _compiled:
+        _compiled[key] = re.compile("|".join("(?:{})".format(p) for p in failures), re.M)
+    return _compiled[key]
+
+def _tail(filename, size=None):
+    " the end of a file (size bytes), from the start of a line "
+    size = size or TAIL
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        start = max(0, f.tell() - size)
+        f.seek(start)
+        text = f.read()
+    instrument.count("files_read"); instrument.count("bytes_read", len(text))
+    if start > 0:
+        text = text[text.find("\n")+1:]
+    return text
+
+def finished(folder, cache_runs, failures=None):
+    """ state of a member which left the queue: done, failed, or None if it did not run
+    (cache_runs: absolute folder ==> exit code)
+    """
+    path = os.path.abspath(folder)
+    if path in cache_runs:
+        return 'done' if cache_runs[path] == 0 else 'failed'
+    err = os.path.join(folder, "out.err")
+    if not os.path.isfile(err):
+        return None if not os.path.isfile(os.path.join(folder, "out.out")) else 'done'
+    failure = _compile(failures or FAILURES)
+    return 'failed' if failure.search(_tail(err)) else 'done'
+
+def poll(batch, db=None, user=None, now=None, failures=None):
+    """ list the queue once, update the state of all members of the batch
+    in its status file (and the registry, if given). Returns the counts by state.
+    failures: failure messages searched in out.err (default: FAILURES)
+    """
+    now = now or time.time()
+    jobs = read_jobs(batch)
+    status = read_status(batch)
+
+    # one listing per queue system
+    listings = {}
+    for queue in set(r['queue'] for r in jobs.itervalues()):
+        listings[queue] = list_queue(queue, user)
+
+    # exit codes recorded by the jobs (see job's run.cache), with relative
+    # or absolute folders (array jobs, see arrayjob.py)
+    cache_runs = dict((os.path.abspath(r['run']), r['exit'])
+                      for r in scheduler.read_cache(os.path.join(batch, scheduler.CACHE_FILE)).itervalues())
+
+    changes = {}
+    for folder, r in jobs.iteritems():
+        previous = status.get(folder, {})
+        if previous.get('job') == r['job'] and previous.get('state') in ('done', 'failed', 'lost'):
+            continue  # final state
+        listing = listings[r['queue']]
+        if listing is None:
+            # queue unavailable: keep the previous state
+            if previous.get('job') == r['job']:
+                continue
+            state = 'submitted'
+        else:
+            state = listing.get(r['job'])
+        if state is None:
+            state = finished(folder, cache_runs, failures)
+        if state is None:
+            seen = previous.get('job') == r['job'] and previous.get('state') in ('queued', 'running')
+            state = 'submitted' if not seen and now - r['submitted'] < GRACE else 'lost'
+        if state != previous.get('state') or previous.get('job') != r['job']:
+            status[folder] = dict(job=r['job'], state=state, since=now)
+            changes[folder] = state
+
+    write_status(batch, status, now)
+    if db is not None and changes:
+        registry.set_status(db, changes, None)
+    return counts(status)
+
+def counts(status):
+    " number of members in each state "
+    n = OrderedDict((s, 0) for s in STATES)
+    for r in status.itervalues():
+        n[r['state']] += 1
+    return n
+
+def write_status(batch, status, now):
+    " write the status file: summary line, then the members (atomic write) "
+    filename = os.path.join(batch, STATUS_FILE)
+    with open(filename+'.tmp', 'w') as f:
+        f.write(json.dumps(dict(updated=now, counts=counts(status)))+"\n")
+        f.write(json.dumps(status)+"\n")
+    os.rename(filename+'.tmp', filename)
+
+def summary(batch):
+    " the summary of the last poll: {'updated': time, 'counts': state ==> number}, or None "
+    try:
+        with open(os.path.join(batch, STATUS_FILE)) as f:
+            return json.loads(f.readline(), object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return None
+
+def read_status(batch):
+    " state of each member at the last poll: folder ==> {'job', 'state', 'since'} "
+    try:
+        with open(os.path.join(batch, STATUS_FILE)) as f:
+            f.readline()
+            return json.loads(f.readline(), object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return OrderedDict()
+
+def active(n):
+    " number of members still to finish "
+    return n['submitted'] + n['queued'] + n['running']
+
+def watch(batches, interval=60, db=None, user=None, verbose=True, failures=None):
+    """ poll the queue every interval seconds, until all members of
+    the batches have left it. Returns the counts of the last poll.
+    """
+    while True:
+        total = OrderedDict((s, 0) for s in STATES)
+        for batch in batches:
+            for s, k in poll(batch, db=db, user=user, failures=failures).iteritems():
+                total[s] += k
+        if verbose:
+            print time.strftime("%H:%M:%S"), ", ".join("{} {}".format(k, s) for s, k in total.iteritems() if k)
+        if not active(total):
+            return total
+        time.sleep(interval)
+
+
+def main(argv=None):
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv)
+    failures = read_failures(args['--failures']) if args['--failures'] else None
+    if args['--once']:
+        for batch in args['<batch>']:
+            n = poll(batch, db=args['--registry'], failures=failures)
+            print batch, ", ".join("{} {}".format(k, s) for s, k in n.iteritems() if k)
+    else:
+        watch(args['<batch>'], interval=float(args['--interval']), db=args['--registry'], failures=failures)
+
+if __name__ == "__main__":
+    main()
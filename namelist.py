@@ -11,9 +11,15 @@ Examples
 """
 from collections import OrderedDict
 import re
+import instrument
+import cache
 
+# The parsed files are kept in the cache of parsed files (see cache.py)
 def read_namelist_file(filename):
-    return Namelist.parse_file(open(filename, 'r').read())
+    return cache.load(filename, "namelist.Namelist", Namelist.parse_file)
+
+def read_namelist_document(filename):
+    return cache.load(filename, "namelist.NamelistDocument", NamelistDocument)
 
 class AttributeMapper():
     """
@@ -42,43 +48,167 @@ class AttributeMapper():
     def __dir__(self):
         return self.data.keys()
 
-def _parse_value(variable_value):
+# Fortran literals
+_int_re = re.compile(r'[+-]?\d+$')
+_float_re = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eEdD][+-]?\d+)?$')
+_true = ('.true.', 't', '.t.')
+_false = ('.false.', 'f', '.f.')
+
+# Namelist statements. Whitespace and comments are skipped as part of the
+# match, so that one match consumes a whole group header, a whole assignment
+# (including multi-line values) or a group terminator. Anything else is
+# matched one character at a time by the last alternative.
+_string = r"""'(?:[^']|'')*'|"(?:[^"]|"")*\""""
+_name = r"[A-Za-z_][\w%]*\s*(?:\(\s*\d+\s*\))?\s*="
+_statement_re = re.compile(r"""
+    \s*(?:![^\n]*\s*)*
+    (?:
+        ([A-Za-z_][\w%]*)\s*(?:\(\s*(\d+)\s*\))?\s*=[ \t]*     # name(index) =
+        (?:
+            # fast path: a single value followed by the next statement
+            (?:([^\s,/!&'"=*]+)|({string}))                    # scalar | quoted
+            [ \t]*,?\s*(?:![^\n]*\s*)*(?=[A-Za-z_][\w%]*\s*[=(]|[/&]|$)
+          | \s*(?:![^\n]*\s*)*
+            (/(?:{string}|[^/'"])*/)?                           # /.../ array
+            ((?:[\s,]+|![^\n]*|{string}|(?!{name})[^\s,/!&'"=]+)*) # values
+        )
+      | &(\w+)                                                  # group
+      | (/)                                                     # end
+      | (\S)                                                    # other
+    )""".format(string=_string, name=_name), re.VERBOSE)
+
+# Items within the values of one assignment: string | repeat count | other
+# (comments match with all groups empty)
+_item_re = re.compile(r"""({string})|(\d+)\*|([^\s,/!'"]+)|![^\n]*""".format(string=_string))
+
+# parsed literals, shared across files since values repeat a lot in ensembles
+_literals = {}
+_values = {} # same for parse_literal
+
+def _parse_value(variable_value, logicals=True):
     """
     Tries to parse a single value, raises an exception if no single value is matched
     """
+    if _int_re.match(variable_value):
+        return int(variable_value)
+    if _float_re.match(variable_value):
+        return float(variable_value.replace('d', 'e').replace('D', 'e'))
+    if logicals:
+        lower = variable_value.lower()
+        if lower in _true:
+            # boolean
+            return True
+        if lower in _false:
+            return False
+    if len(variable_value) > 1 and variable_value[0] in "'\"" \
+        and variable_value[-1] == variable_value[0] \
+        and variable_value.count(variable_value[0]) == 2:
+        # string
+        return variable_value[1:-1]
+    if variable_value.startswith("/") and variable_value.endswith("/"):
+        # array /3,4,5/
+        return [_parse_value(v.strip(), logicals) for v in variable_value[1:-1].split(',')]
+    if len(variable_value.split()) > 1:
+        # array 3 4 5
+        return [_parse_value(v, logicals) for v in variable_value.split()]
+    raise ValueError(variable_value)
+
+def parse_literal(string):
+    """ Parse a value of a line-by-line parameter file (see parameters.py):
+    int, float (Fortran d exponent included), quoted string, or vector of 
+    these. Anything else is returned as the string itself, never evaluated.
+    Logicals are left as strings (e.g. T or F), since these formats may
+    also use such names as plain string values.
+    """
     try:
-        parsed_value = int(variable_value)
-    except ValueError:
+        value = _values[string]
+    except KeyError:
+        if len(_values) > 100000:
+            _values.clear()
         try:
-            parsed_value = float(variable_value)
+            value = _parse_value(string, logicals=False)
         except ValueError:
-            if variable_value.lower() in ['.true.', 't']:
-                # boolean
-                parsed_value = True
-            elif variable_value.lower() in ['.false.', 'f']:
-                parsed_value = False
-            elif variable_value.startswith("'") \
-                and variable_value.endswith("'") \
-                and variable_value.count("'") == 2 \
-            or variable_value.startswith('"') \
-                and variable_value.endswith('"') \
-                and variable_value.count('"') == 2:
-                # string
-                parsed_value = variable_value[1:-1]
-            elif variable_value.startswith("/") and variable_value.endswith("/"):
-                # array /3,4,5/
-                parsed_value = []
-                for v in variable_value[1:-1].split(','):
-                    parsed_value.append(_parse_value(v))
-            elif len(variable_value.split()) > 1:
-                # array 3 4 5
-                parsed_value = []
-                for v in variable_value.split(' '):
-                    parsed_value.append(_parse_value(v))
-            else:
-                raise ValueError(variable_value)
+            value = string
+        _values[string] = value
+    if type(value) is list:
+        return list(value) # not shared with other parameters
+    return value
+
+def _unquote(token):
+    " remove the quotes around a string token, Fortran-style doubled quotes included "
+    q = token[0]
+    return token[1:-1].replace(q+q, q)
 
-    return parsed_value
+def _literal(token):
+    " cached version of _parse_value, for unquoted tokens "
+    try:
+        return _literals[token]
+    except KeyError:
+        if len(_literals) > 100000:
+            _literals.clear()
+        value = _literals[token] = _parse_value(token)
+        return value
+
+def _parse_items(string):
+    """ parse the values of one assignment into a list, also return True if
+    written with explicit array syntax (a repeat count)
+    """
+    values = []
+    repeat = 1
+    array = False
+    for quoted, count, token in _item_re.findall(string):
+        if token:
+            value = _literal(token)
+        elif quoted:
+            value = _unquote(quoted)
+        elif count:
+            repeat = int(count)
+            array = True
+            continue
+        else:
+            continue # comment
+        if repeat == 1:
+            values.append(value)
+        else:
+            values.extend([value]*repeat)
+            repeat = 1
+    return values, array
+
+def _assign(group, name, index, values, array):
+    " store the values of one assignment into the group "
+    if not values:
+        return # null value: leave the variable untouched
+    if index:
+        # name(i) = v1 v2 ... fills the array from position i on
+        index = int(index)
+        current = group.get(name)
+        if not isinstance(current, list):
+            current = [] if current is None else [current]
+        n = index - 1 + len(values)
+        if len(current) < n:
+            current.extend([None]*(n - len(current)))
+        current[index-1:n] = values
+        group[name] = current
+    elif len(values) == 1 and not array:
+        group[name] = values[0]
+    else:
+        group[name] = values
+
+def _unfilled(group):
+    """ keep the arrays with unfilled positions as their indexed entries
+    name(i) = v, as written in the file, since the missing values are unknown
+    """
+    if not any(isinstance(value, list) and None in value for value in group.itervalues()):
+        return
+    items = group.items()
+    group.clear()
+    for name, value in items:
+        if isinstance(value, list) and None in value:
+            for i, v in enumerate(value):
+                if v is not None:
+                    group["%s(%d)" % (name, i+1)] = v
+        else:
+            group[name] = value
 
 class Namelist(object):
     """
@@ -90,54 +220,49 @@ class Namelist(object):
 
     @classmethod
     def parse_file(cls, input_str):
-        groups = OrderedDict()
+        """ Parse a namelist string in a single pass.
 
-        group_re = re.compile(r'&([^&]+)/', re.DOTALL)  # allow blocks to span multiple lines
-        array_re = re.compile(r'(\w+)\((\d+)\)')
-        # string_re = re.compile(r"\'\s*\w[^']*\'")
-        string_re = re.compile(r"[\'\"]*[\'\"]")
-        # self._complex_re = re.compile(r'^\((\d+.?\d*),(\d+.?\d*)\)$')
-
-        # remove all comments, since they may have forward-slashes
-        # TODO: store position of comments so that they can be re-inserted when
-        # we eventually save
-        filtered_lines = []
-        for line in input_str.split('\n'):
-            if '!' in line:
-                line = line[:line.index('!')]
-            if line.strip() == "":
-                continue
-            else:
-                filtered_lines.append(line)
-
-        group_blocks = re.findall(group_re, "\n".join(filtered_lines))
-
-        for i, group_block in enumerate(group_blocks):
-            block_lines = group_block.split('\n')
-            group_name = block_lines.pop(0).strip()
-
-            group = OrderedDict()
+        Supports multi-line and comma-separated arrays, /1., 2./ arrays, 
+        indexed assignments name(i) = ..., repeat counts 3*0. and quoted
+        strings that contain commas, slashes or exclamation marks. Arrays
+        whose indexed assignments leave positions unfilled are kept as
+        their entries name(i).
+        """
+        groups = OrderedDict()
+        group = None # variables of the current group (None outside &.../)
 
-            for line in block_lines:
-                line = line.strip()
-                if line == "":
+        for name, index, scalar, quoted, slashed, values, group_name, end, other \
+                in _statement_re.findall(input_str):
+            if name:
+                if group is None:
                     continue
-                if line.startswith('!'):
+                if scalar and not index:
+                    try:
+                        group[name] = _literals[scalar]
+                    except KeyError:
+                        group[name] = _literal(scalar)
                     continue
+                if scalar:
+                    items, array = [_literal(scalar)], False
+                elif quoted:
+                    items, array = [_unquote(quoted)], False
+                elif slashed:
+                    # array /3,4,5/
+                    items, array = _parse_items(slashed[1:-1])
+                    array = True
+                else:
+                    items, array = _parse_items(values)
+                _assign(group, name, index, items, array)
+            elif group_name:
+                group = groups[group_name] = OrderedDict()
+            elif end:
+                group = None
+            elif group is not None:
+                raise ValueError("Unexpected character in namelist group: {!r}".format(other))
+            # else: free text between groups is ignored
 
-                # commas at the end of lines seem to be optional
-                if line.endswith(','):
-                    line = line[:-1]
-
-                k, v = line.split('=')
-                variable_name = k.strip()
-                variable_value = v.strip()
-
-                parsed_value = _parse_value(variable_value)
-                group[variable_name] = parsed_value
-
-        
-            groups[group_name] = group
+        for group in groups.itervalues():
+            _unfilled(group)
 
         # Return namelist class
         return cls(groups)
@@ -168,7 +293,7 @@ class Namelist(object):
             # return "{:.3e}".format(value) # use exp. notation after 3 digits
             return "{}".format(value) # use exp. notation after 3 digits
         elif isinstance(value, basestring):
-            return "'%s'" % value
+            return "'%s'" % value.replace("'", "''")
         elif isinstance(value, complex):
             return "(%s,%s)" % (self._format_value(value.real), self._format_value(value.imag))
         else:
@@ -177,3 +302,150 @@ class Namelist(object):
     @property
     def data(self):
         return AttributeMapper(self.groups)
+
+
+class NamelistDocument(Namelist):
+    """
+    A namelist file which keeps its original text (comments, ordering and
+    formatting), for lossless editing: set() only rewrites the values that 
+    actually change, and write() leaves the file untouched if its content
+    would be the same.
+
+    >>> control = read_namelist_document("control.nml")
+    >>> control.set('time', 'year0', control.groups['time']['year0'] + 100)
+    >>> control.write("control.nml")
+    """
+    def __init__(self, text):
+        self.text = text
+        self.groups = Namelist.parse_file(text).groups
+        self._locate()
+        self._patches = OrderedDict() # (group, name) ==> [(start, end, new text)]
+
+    @classmethod
+    def parse_file(cls, input_str):
+        return cls(input_str)
+
+    def _locate(self):
+        """ find the position of each assignment in the text:
+        (group, name) ==> [(statement start, value start, value end, index)]
+        and the position of the end of each group
+        """
+        self._assignments = {}
+        self._ends = {}
+        group = None
+        for m in _statement_re.finditer(self.text):
+            name, index, scalar, quoted, slashed, values, group_name, end, other = m.groups()
+            if name:
+                if group is None:
+                    continue
+                if scalar or quoted:
+                    span = m.span(3) if scalar else m.span(4)
+                elif slashed:
+                    span = m.span(5)
+                else:
+                    # the values, without trailing comments and separators
+                    items = [item for item in _item_re.finditer(values) if item.group(0)[0] != '!']
+                    offset = m.start(6)
+                    if items:
+                        span = offset + items[0].start(), offset + items[-1].end()
+                    else:
+                        span = offset, offset
+                self._assignments.setdefault((group, name), []).append((m.start(1),) + span + (index,))
+                if index:
+                    # entry of an array with unfilled positions (see _unfilled)
+                    key = (group, "%s(%d)" % (name, int(index)))
+                    self._assignments.setdefault(key, []).append((m.start(1),) + span + (index,))
+            elif group_name:
+                group = group_name
+            elif end:
+                self._ends[group] = m.start(8)
+                group = None
+
+    def _format(self, value):
+        if isinstance(value, list):
+            return " ".join([self._format_value(v) for v in value])
+        return self._format_value(value)
+
+    def set(self, group, name, value):
+        """ set the value of a variable, only touching the text if it changes 
+        (new variables are added at the end of their group, new groups at
+        the end of the file)
+        """
+        current = self.groups.get(group, {})
+        if name in current and type(current[name]) is type(value) and current[name] == value:
+            return
+        self.groups.setdefault(group, OrderedDict())[name] = value
+        
+        assignments = self._assignments.get((group, name))
+        if not assignments:
+            # new variable, before the end of its group, with the indentation of the last one
+            if group in self._ends:
+                pos = self.text.rfind('\n', 0, self._ends[group]) + 1
+                indent = "  "
+                last = [a[0] for (g, n), al in self._assignments.iteritems() if g == group for a in al]
+                if last:
+                    start = self.text.rfind('\n', 0, max(last)) + 1
+                    if not self.text[start:max(last)].strip():
+                        indent = self.text[start:max(last)]
+                line = "%s%s = %s\n" % (indent, name, self._format(value))
+                if self.text[pos:self._ends[group]].strip():
+                    # the group ends on the line of its last statement
+                    pos = self._ends[group]
+                    line = "\n" + line
+                patch = (pos, pos, line)
+            else:
+                group_text = "&%s\n  %s = %s\n/\n" % (group, name, self._format(value))
+                pos = len(self.text)
+                if self.text and not self.text.endswith('\n'):
+                    group_text = "\n" + group_text
+                patch = (pos, pos, group_text)
+            self._patches[(group, name)] = [patch]
+        elif len(assignments) == 1 and not assignments[0][3]:
+            # the usual case: only replace the value
+            start, end = assignments[0][1:3]
+            self._patches[(group, name)] = [(start, end, self._format(value))]
+        else:
+            # indexed or repeated assignments: replace them with a single one
+            start, _, end, _ = assignments[0]
+            patches = [(start, end, "%s = %s" % (name, self._format(value)))]
+            patches.extend((a[0], a[2], "") for a in assignments[1:])
+            self._patches[(group, name)] = patches
+
+    def update(self, groups):
+        " set all variables of a dict of groups: group name ==> {name: value} "
+        for group in groups:
+            for name in groups[group]:
+                self.set(group, name, groups[group][name])
+
+    def dump(self):
+        " return the text, with all changes "
+        if not self._patches:
+            return self.text
+        patches = sorted((p for pl in self._patches.itervalues() for p in pl), key=lambda p: p[0])
+        parts = []
+        pos = 0
+        for start, end, text in patches:
+            parts.append(self.text[pos:start])
+            parts.append(text)
+            pos = max(pos, end)
+        parts.append(self.text[pos:])
+        return "".join(parts)
+
+    def write(self, filename):
+        """ write to file, unless the file already has that content
+        (so that its modification time only changes with its content).
+        Return True if the file was written.
+        """
+        text = self.dump()
+        try:
+            with open(filename, 'r') as f:
+                if f.read() == text:
+                    return False
+        except IOError:
+            pass
+        with instrument.phase("write", file=filename):
+            with open(filename, 'w') as f:
+                f.write(text)
+        instrument.count("files_written")
+        instrument.count("bytes_written", len(text))
+        return True
@@ -4,20 +4,20 @@
 from collections import OrderedDict as odict
 import warnings
 import copy
+import mmap
+import os
+import re
 from itertools import groupby
 from functools import wraps
-from namelist import Namelist
+from namelist import Namelist, parse_literal as _parse_value
+import instrument
+import cache
 # from models import climber2, sico, rembo, outletglacier
 
-def _parse_value(v):
-    try:
-        return eval(v)
-    except:
-        return v
-
 #
 # Namelist
 # 
+@instrument.timed("format.nml")
 def _to_str_nml(params):
     """ Write with namelist format
     """
@@ -32,6 +32,7 @@ def _to_str_nml(params):
     string = nml.dump()
     return string
 
+@instrument.timed("parse.nml")
 def _parse_file_nml(cls, string):
     nml = Namelist.parse_file(string)
 
@@ -87,17 +88,25 @@ def _parse_line_alex(string):
     line = string[0:41]
     return Parameter(name=name, value=value, units=units, line=line) 
 
+@instrument.timed("parse.alex")
 def _parse_file_alex(cls, string):
     return _parse_file_linebyline_generic(cls, string, _parse_line_alex)
 
+def _format_alex(value):
+    " format a value, vectors as space-separated values (strings quoted) "
+    if isinstance(value, list):
+        return " ".join([repr(v) if isinstance(v, basestring) else "{}".format(v) for v in value])
+    return "{}".format(value)
+
 def _param_to_line_alex(param):
     if param.line:
-        l = "{} {}".format(param.line,param.value)
+        l = "{} {}".format(param.line,_format_alex(param.value))
     else:
-        line = "{name} - {desc} ({units})".format(**param.__dict__)
-        l = "{line:39} = {value}".format(line=line, value=param.value)
+        line = "{p.name} - {p.desc} ({p.units})".format(p=param)
+        l = "{line:39} = {value}".format(line=line, value=_format_alex(param.value))
     return l
 
+@instrument.timed("format.alex")
 def _to_str_alex(params):
     return _to_str_linebyline_generic(params, _param_to_line_alex)
 
@@ -118,13 +127,23 @@ def _parse_line_climber2(string):
 
     return Parameter(name=name, line=line, value=value)
 
+@instrument.timed("parse.climber2")
 def _parse_file_climber2(cls, string):
     return _parse_file_linebyline_generic(cls, string, _parse_line_climber2, comment='=')
 
+def _format_climber2(value):
+    " format a value, vectors as space-separated values "
+    if isinstance(value, list):
+        value = " ".join([repr(v) for v in value])
+    else:
+        value = repr(value)
+    return "{:<9}".format(value)
+
 def _param_to_line_climber2(param):
-    line = param.line or "{name} : {desc} ({units})".format(**param.__dict__)
-    return " {:<9}| {}".format(repr(param.value),line)
+    line = param.line or "{p.name} : {p.desc} ({p.units})".format(p=param)
+    return " {}| {}".format(_format_climber2(param.value),line)
 
+@instrument.timed("format.climber2")
 def _to_str_climber2(params):
     return _to_str_linebyline_generic(params, _param_to_line_climber2)
 
@@ -132,16 +151,38 @@ def _to_str_climber2(params):
 # Parameter class
 #
 
+def _intern(s):
+    " intern byte strings, so that identical attributes share memory "
+    return intern(s) if type(s) is str else s
+
 class Parameter(object):
     """ Contain infos for one parameter
+
+    Uses __slots__ and interned strings for all attributes but value, 
+    since large ensembles hold many copies of the same parameters.
     """
+    __slots__ = ('name', 'value', 'units', 'group', 'desc', 'line')
+
     def __init__(self,name="",value="",units="", desc="", line="", group=""):
-        self.name = name
+        self.name = _intern(name)
         self.value = value
-        self.units = units
-        self.group = group # namelist group
-        self.desc = desc 
-        self.line = line  # the fixed part of the line, all but the valueone
+        self.units = _intern(units)
+        self.group = _intern(group) # namelist group
+        self.desc = _intern(desc)
+        self.line = _intern(line)  # the fixed part of the line, all but the valueone
+
+    def __copy__(self):
+        new = Parameter.__new__(self.__class__)
+        for attr in self.__slots__:
+            setattr(new, attr, getattr(self, attr))
+        return new
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, v in zip(self.__slots__, state):
+            setattr(self, attr, v)
 
     def short(self):
         '''Output short string representation of parameter and value.
@@ -166,8 +207,6 @@ class Parameter(object):
         
     def __repr__(self):
         " informative representation, in prompt"
-        # return "{cls}({group},{name},{value})".format(cls=self.__class__.__name__, **self.__dict__)
-        # return "P({group},{name},{value})".format(**self.__dict__)
         return "P(%r, %r, %r)" % (self.group, self.name, self.value)
 
     @property
@@ -183,6 +222,15 @@ class Parameter(object):
         return hash(self.key)
 
 
+def _invalidates(method):
+    " decorator for list methods after which the indexes must be rebuilt "
+    @wraps(method, assigned=("__name__", "__doc__"), updated=())
+    def wrapper(self, *args, **kwargs):
+        self._indexes = None
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Parameters(list):
     """ The data structure of a parameter list. 
 
@@ -196,11 +244,121 @@ class Parameters(list):
     which identifies one parameter uniquely, on which __eq__ is based,
     and therefore the list.index() function can be called on a parameter
 
+    Lookups by key, name and group go through hash indexes (attribute value
+    ==> list of positions), built on first use, kept up to date by append
+    and extend, and rebuilt after any other modification of the list.
+    Change the name or group of contained parameters via set_group (or call
+    reindex() afterwards), since the indexes cannot see such changes.
+
     Additional methods shipped with list:
     - append : append new element
     - extends : extend with another list
     - sort : in-place sort (can be provided with a key function)
     """
+    _indexed = ('key', 'name', 'group')
+
+    def __init__(self, params=()):
+        list.__init__(self, params)
+        self._indexes = None
+
+    #
+    # indexes
+    #
+    def _build_indexes(self):
+        indexes = {}
+        for attr in self._indexed:
+            index = indexes[attr] = odict()
+            for i, p in enumerate(self):
+                v = getattr(p, attr)
+                if v in index:
+                    index[v].append(i)
+                else:
+                    index[v] = [i]
+        self._indexes = indexes
+        return indexes
+
+    def _index(self, attr):
+        " return the index for one attribute: value ==> list of positions "
+        indexes = self._indexes
+        if indexes is None:
+            indexes = self._build_indexes()
+        return indexes[attr]
+
+    def reindex(self):
+        " drop the indexes, to rebuild them on next lookup "
+        self._indexes = None
+
+    def __reduce__(self):
+        # pickled as a plain list of parameters (see cache.py), without the indexes
+        return self.__class__, (list(self),)
+
+    def _positions(self, kwargs):
+        """ positions of the parameters that may match kwargs according to 
+        the indexes, or None if no index applies
+        """
+        if 'name' in kwargs and 'group' in kwargs:
+            return self._index('key').get((kwargs['group'], kwargs['name']), [])
+        for attr in self._indexed:
+            if attr in kwargs:
+                return self._index(attr).get(kwargs[attr], [])
+        return None
+
+    #
+    # list methods that maintain or invalidate the indexes
+    #
+    def append(self, p):
+        list.append(self, p)
+        if self._indexes is not None:
+            i = len(self) - 1
+            for attr in self._indexed:
+                self._indexes[attr].setdefault(getattr(p, attr), []).append(i)
+
+    def extend(self, params):
+        for p in params:
+            self.append(p)
+
+    def __iadd__(self, params):
+        self.extend(params)
+        return self
+
+    def __setitem__(self, i, p):
+        if isinstance(i, slice) or self._indexes is None:
+            self._indexes = None
+        elif p.key != self[i].key:
+            self._indexes = None
+        list.__setitem__(self, i, p)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.__class__(list.__getitem__(self, i))
+        return list.__getitem__(self, i)
+
+    def __getslice__(self, i, j):
+        return self.__class__(list.__getslice__(self, i, j))
+
+    __setslice__ = _invalidates(list.__setslice__)
+    __delslice__ = _invalidates(list.__delslice__)
+    __delitem__ = _invalidates(list.__delitem__)
+    __imul__ = _invalidates(list.__imul__)
+    insert = _invalidates(list.insert)
+    pop = _invalidates(list.pop)
+    remove = _invalidates(list.remove)
+    reverse = _invalidates(list.reverse)
+    sort = _invalidates(list.sort)
+
+    def index(self, p):
+        " position of the first parameter with the same key as p "
+        positions = self._index('key').get(p.key)
+        if not positions:
+            raise ValueError("{} is not in list".format(p.key))
+        return positions[0]
+
+    def __contains__(self, p):
+        return p.key in self._index('key')
+
+    #
+    # search and update
+    #
     def filter(self, **kwargs):
         """ filter parameters by any parameter attribute, returns a sub-list 
         >>> params.filter(group="basal")
@@ -211,7 +369,10 @@ class Parameters(list):
                 if getattr(p, k) != kwargs[k]: 
                     return False
             return True
-        return self.__class__(p for p in self if test(p))
+        positions = self._positions(kwargs)
+        if positions is None:
+            return self.__class__(p for p in self if test(p))
+        return self.__class__(p for p in (self[i] for i in positions) if test(p))
 
     def item(self, **kwargs):
         """ same as filter, but return a single parameter (or raise error)
@@ -228,34 +389,40 @@ class Parameters(list):
 
         Note: use self.update([p]) to add a single parameter
         """
+        index = self._index('key')
         for p in params:
+            positions = index.get(p.key)
             # replace if element already exists
-            try:
-                i = self.index(p)
+            if positions:
+                i = positions[0]
                 if verbose: 
                     print "{}: {} ==> {}".format(p.key, self[i].value, p.value)
-                self[i] = p  # update existing parameter
+                list.__setitem__(self, i, p)  # update existing parameter, same key
             # otherwise just append 
-            except:
+            else:
                 self.append(p)
 
     def copy(self):
-        return [copy.copy(p) for p in self]
+        return self.__class__(copy.copy(p) for p in self)
 
     def keys(self, key='key'):
         """ check all available values for a particular attribute
         >>> params.keys('group')
         ['submelt', 'dynamic', 'calving']
         """
+        if key in self._indexed:
+            return self._index(key).keys()
         return self.to_dict(key).keys()
 
     def to_dict(self, key='key'):
         " return an ordered dict (automatically drop duplicates w.r.t the key !)"
+        if key in self._indexed:
+            return odict([(k, self[positions[-1]]) for k, positions in self._index(key).iteritems()])
         return odict([(getattr(p, key),p) for p in self])
 
     def has_duplicates(self):
         " return True if all elements have distinct keys"
-        return len(set(self)) != len(self) # set uses __hash__ to remove duplicates
+        return len(self._index('key')) != len(self)
 
     def drop_duplicates(self):
         " "
@@ -275,6 +442,7 @@ class Parameters(list):
         """
         for p in self.filter(**kwargs):
             p.group = newgroup
+        self._indexes = None
 
     def get(self, name, **kwargs):
         " get value of one parameter, identified by its name and other attributes"
@@ -295,44 +463,496 @@ class Parameters(list):
             # ==> will simply output the string
             return file_str
         if verbose: print "Write params to {}".format(filename)
-        with open(filename, "w") as f:
-            f.write(file_str)
+        with instrument.phase("write", file=filename):
+            with open(filename, "w") as f:
+                f.write(file_str)
+        instrument.count("files_written")
+        instrument.count("bytes_written", len(file_str))
 
-    @staticmethod
-    def _read_to_str(filename, verbose):
-        " read a file to string "
+    @classmethod
+    def _read_parsed(cls, filename, parse, verbose):
+        " read and parse a file, or load it from the cache of parsed files (see cache.py) "
         if verbose: print "Read params from {}".format(filename)
-        with open(filename) as f:
-            file_str = f.read()
-        return file_str
+        kind = "{}.{}.{}".format(cls.__module__, cls.__name__, parse.__name__)
+        return cache.load(filename, kind, lambda file_str: parse(cls, file_str))
 
     @classmethod
-    def read_nml(cls, filename, verbose=True):
-        file_str = cls._read_to_str(filename, verbose=verbose)
-        return _parse_file_nml(cls, file_str)
+    def read_nml(cls, filename, verbose=True, lazy=False):
+        if lazy:
+            return LazyParameters(filename, "nml", cls, verbose)
+        return cls._read_parsed(filename, _parse_file_nml, verbose)
 
     def write_nml(self, filename, verbose=True):
         file_str = _to_str_nml(self)
         return self._write_from_str(filename, file_str, verbose)
 
     @classmethod
-    def read_alex(cls, filename, verbose=True):
-        file_str = cls._read_to_str(filename, verbose=verbose)
-        return _parse_file_alex(cls, file_str)
+    def read_alex(cls, filename, verbose=True, lazy=False):
+        if lazy:
+            return LazyParameters(filename, "alex", cls, verbose)
+        return cls._read_parsed(filename, _parse_file_alex, verbose)
 
     def write_alex(self, filename, verbose=True):
         file_str = _to_str_alex(self)
         return self._write_from_str(filename, file_str, verbose)
 
     @classmethod
-    def read_climber2(cls, filename, verbose=True):
-        file_str = cls._read_to_str(filename, verbose=verbose)
-        return _parse_file_climber2(cls, file_str)
+    def read_climber2(cls, filename, verbose=True, lazy=False):
+        if lazy:
+            return LazyParameters(filename, "climber2", cls, verbose)
+        return cls._read_parsed(filename, _parse_file_climber2, verbose)
 
     def write_climber2(self, filename, verbose=True):
         file_str = _to_str_climber2(self)
         return self._write_from_str(filename, file_str, verbose)
  
+
+#
+# Lazy reader
+#
+def _name_alex(line):
+    " name of a parameter line, as found by _parse_line_alex "
+    line = line.partition(":")[2]
+    return line.partition(":" if ":" in line else "=")[0].strip()
+
+def _name_climber2(line):
+    " name of a parameter line, as found by _parse_line_climber2 "
+    return line.partition("|")[2].partition("|")[0].strip()
+
+# line formats: comment character, name of a line, parser of a line
+_LAZY_FORMATS = {
+    'alex': ("#", _name_alex, _parse_line_alex),
+    'climber2': ("=", _name_climber2, _parse_line_climber2),
+}
+_group_re = re.compile(r"&(\w+)")
+
+class LazyParameters(object):
+    """ Parameters of a file, parsed on demand
+
+    Opening the file only memory-maps it (and indexes the position of each
+    group, for namelists). Lookups by name (get, item, set, filter) find
+    the lines of that name in the mapped file, by searching for the name
+    itself, and only parse these lines (or the groups, for namelists: give
+    the group to parse only that one). The positions found and the parsed
+    parameters are kept. Anything else (iterating, writing, other methods
+    of Parameters) first parses the whole file into a Parameters instance,
+    which reuses the parameters already parsed (and modified).
+
+    Files smaller than MMAP_SIZE are simply read. The map of a larger file
+    is closed once the file is fully parsed, or by close() (or at the end
+    of a with block): only the parameters already parsed remain available.
+
+    >>> with Parameters.read_alex("options_rembo", lazy=True) as params:
+    ...     params.get("pdd_factor")
+    1.0
+    """
+    MMAP_SIZE = 1 << 20  # smaller files are read at once
+
+    def __init__(self, filename, format, cls=None, verbose=True):
+        if verbose: print "Read params from {} (lazy)".format(filename)
+        self.filename = filename
+        self.format = format
+        self.cls = cls or Parameters
+        self._params = None   # all parameters, once materialised
+        self._parsed = {}     # position of a line (group) ==> Parameter (list of)
+        with instrument.phase("index", file=filename):
+            with open(filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size >= self.MMAP_SIZE:
+                    self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._text = f.read()
+            self._index = self._groups() if format == "nml" else {}
+        instrument.count("files_read")
+
+    def _file(self):
+        " text of the file (mapped or read) "
+        if self._text is None:
+            raise ValueError("{} is closed".format(self.filename))
+        return self._text
+
+    def _lines(self):
+        " (start, end) of the parameter lines of the file, and the lines "
+        comment = _LAZY_FORMATS[self.format][0]
+        start = 0
+        for line in self._file()[:].split("\n"):
+            end = start + len(line)
+            if line != "" and not line.startswith(comment):
+                yield (start, end), line
+            start = end + 1
+
+    def _groups(self):
+        " namelist group ==> list of (start, end) of its text "
+        text = self._text
+        # groups start on their own line: &name
+        starts = [(m.start(), m.group(1)) for m in _group_re.finditer(text)
+                  if not text[text.rfind("\n", 0, m.start())+1:m.start()].strip()]
+        ends = [start for start, _ in starts[1:]] + [len(text)]
+        index = {}
+        for (start, group), end in zip(starts, ends):
+            index.setdefault(group, []).append((start, end))
+        return index
+
+    def _find(self, name):
+        " (start, end) of the parameter lines of name, found once "
+        if name in self._index:
+            return self._index[name]
+        comment, name_of, _ = _LAZY_FORMATS[self.format]
+        if not name:
+            spans = [span for span, line in self._lines() if name_of(line) == name]
+        else:
+            # the lines where the name appears, and which define it
+            text = self._file()
+            spans = []
+            pos = text.find(name)
+            while pos >= 0:
+                start = text.rfind("\n", 0, pos) + 1
+                end = text.find("\n", pos)
+                if end < 0:
+                    end = len(text)
+                line = text[start:end]
+                if not line.startswith(comment) and name_of(line) == name:
+                    spans.append((start, end))
+                pos = text.find(name, end)
+        self._index[name] = spans
+        return spans
+
+    def _parse(self, span):
+        " the parameters of a line (or group) of the file, parsed once "
+        if span not in self._parsed:
+            text = self._file()[span[0]:span[1]]
+            if self.format == "nml":
+                self._parsed[span] = list(_parse_file_nml(self.cls, text))
+            else:
+                self._parsed[span] = [_LAZY_FORMATS[self.format][2](text)]
+        return self._parsed[span]
+
+    def _candidates(self, kwargs):
+        " the parameters which may match kwargs, or None if all must be parsed "
+        if self._params is not None:
+            return None
+        if self.format == "nml":
+            if 'group' not in kwargs:
+                return None
+            spans = self._index.get(kwargs['group'], [])
+        elif 'name' in kwargs:
+            spans = self._find(kwargs['name'])
+        else:
+            return None
+        return self.cls(p for span in spans for p in self._parse(span))
+
+    def materialize(self):
+        " all parameters of the file, as a Parameters instance (parsed once) "
+        if self._params is None:
+            with instrument.phase("parse.lazy", file=self.filename):
+                if self.format == "nml":
+                    spans = sorted(span for spans in self._index.itervalues() for span in spans)
+                    params = self.cls(p for span in spans for p in self._parse(span))
+                else:
+                    params = self.cls(p for span, _ in self._lines() for p in self._parse(span))
+            self._params = params
+            self._parsed = None
+            self._index = None
+            self.close()
+        return self._params
+
+    def close(self):
+        " close the map of the file (lookups then only find the parameters already parsed) "
+        if self._text is not None and not isinstance(self._text, str):
+            self._text.close()
+        self._text = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def filter(self, **kwargs):
+        candidates = self._candidates(kwargs)
+        if candidates is None:
+            return self.materialize().filter(**kwargs)
+        return candidates.filter(**kwargs)
+
+    def item(self, **kwargs):
+        r = self.filter(**kwargs)
+        assert len(r) == 1, "{} match(es) for {}".format(len(r), kwargs)
+        return r[0]
+
+    def get(self, name, **kwargs):
+        return self.item(name=name, **kwargs).value
+
+    def set(self, name, value, **kwargs):
+        self.item(name=name, **kwargs).value = value
+
+    def __getattr__(self, attr):
+        # other methods and attributes of Parameters
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.materialize(), attr)
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __getitem__(self, i):
+        return self.materialize()[i]
+
+    def __contains__(self, p):
+        return p in self.materialize()
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+class ParameterTable(object):
+    """ Compact storage for an ensemble of parameter sets.
+
+    All members share one schema (a Parameters instance, usually the defaults)
+    and only store a tuple of values, in the schema's order. Members are 
+    accessed as lightweight views, and only materialised as Parameters 
+    on demand (e.g. to write them to file).
+
+    >>> table = ParameterTable(Parameters.read_nml("params.nml"))
+    >>> table.append([Parameter(group="dynamics", name="beta", value=4e4)])
+    0
+    >>> table[0].get("beta")
+    40000.0
+    >>> table.column("beta")
+    [40000.0]
+    >>> table[0].to_parameters().write_nml("member0.nml")
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self._defaults = tuple(p.value for p in schema)
+        self._values = []
+
+    def _position(self, name, **kwargs):
+        " position of one parameter in the schema "
+        return self.schema.index(self.schema.item(name=name, **kwargs))
+
+    def append(self, params=()):
+        """ add a member, with the schema's values updated by params 
+        (any iterable of Parameter), and return its index
+        """
+        params = list(params)
+        if params:
+            values = list(self._defaults)
+            index = self.schema._index('key')
+            for p in params:
+                positions = index.get(p.key)
+                if not positions:
+                    raise KeyError("{} not in schema".format(p.key))
+                values[positions[0]] = p.value
+            values = tuple(values)
+        else:
+            values = self._defaults
+        self._values.append(values)
+        return len(self._values) - 1
+
+    def extend(self, members):
+        for params in members:
+            self.append(params)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, i):
+        return ParameterView(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self._values)):
+            yield ParameterView(self, i)
+
+    def get(self, i, name, **kwargs):
+        " get value of one parameter for member i "
+        return self._values[i][self._position(name, **kwargs)]
+
+    def set(self, i, name, value, **kwargs):
+        " set value of one parameter for member i "
+        values = list(self._values[i])
+        values[self._position(name, **kwargs)] = value
+        self._values[i] = tuple(values)
+
+    def column(self, name, **kwargs):
+        " values of one parameter across all members "
+        k = self._position(name, **kwargs)
+        return [values[k] for values in self._values]
+
+    def diff(self, i):
+        " parameters of member i which differ from the schema "
+        return self.schema.__class__(_materialise(p, v) 
+            for p, v, v0 in zip(self.schema, self._values[i], self._defaults) if v != v0)
+
+    def to_parameters(self, i):
+        " materialise member i as a new Parameters instance "
+        return self.schema.__class__(_materialise(p, v) 
+            for p, v in zip(self.schema, self._values[i]))
+
+    def changes(self, i):
+        """ (schema position, value) of the parameters of member i which differ 
+        from the schema, including in type or representation (e.g. True and 1,
+        or 0.0 and -0.0, are written differently)
+        """
+        values = self._values[i]
+        if values is self._defaults:
+            return []
+        return [(k, v) for k, (v, v0) in enumerate(zip(values, self._defaults)) 
+                if v is not v0 and (type(v) is not type(v0) or repr(v) != repr(v0))]
+
+    def write(self, filenames, format="nml", verbose=False):
+        """ write all members to files (one file name per member), 
+        with the same content as to_parameters(i).write_<format>, but 
+        much faster for large ensembles (see Template)
+        """
+        return Template(self.schema, format).write_members(self, filenames, verbose=verbose)
+
+
+class ParameterView(object):
+    """ Lightweight view on one member of a ParameterTable
+    """
+    __slots__ = ('table', 'i')
+
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+
+    def get(self, name, **kwargs):
+        return self.table.get(self.i, name, **kwargs)
+
+    def set(self, name, value, **kwargs):
+        self.table.set(self.i, name, value, **kwargs)
+
+    def diff(self):
+        return self.table.diff(self.i)
+
+    def to_parameters(self):
+        return self.table.to_parameters(self.i)
+
+    def __repr__(self):
+        return "{}({!r}, {})".format(self.__class__.__name__, self.table, self.i)
+
+def _materialise(p, value):
+    " copy of parameter p with another value "
+    new = copy.copy(p)
+    new.value = value
+    return new
+
+
+#
+# Bulk writer
+#
+_nml = Namelist(odict())
+
+def _format_nml(value):
+    " format a value as in Namelist.dump "
+    if isinstance(value, list):
+        return " ".join([_nml._format_value(v) for v in value])
+    return _nml._format_value(value)
+
+class Template(object):
+    """ A parameter file rendered once, with a slot for each value, so that
+    the files of the members of an ensemble are obtained by only formatting
+    the values which differ from the schema (usually the defaults).
+
+    The output is the same as with the write_nml, write_alex and 
+    write_climber2 methods of Parameters.
+
+    >>> template = Template(Parameters.read_nml("params.nml"), "nml")
+    >>> template.render([(3, 4e4)])   # changed values, by schema position
+    >>> template.write_members(table, ["output/{}/params.nml".format(i) for i in range(len(table))])
+    """
+    def __init__(self, schema, format="nml"):
+        self.schema = schema
+        self.format = format
+        self._parts = []   # the text of the schema, with values at the slots
+        self._slots = {}   # schema position ==> [(index in _parts, format function)]
+        getattr(self, "_compile_"+format)(schema)
+
+    def _literal(self, text):
+        self._parts.append(text)
+
+    def _slot(self, position, format):
+        self._slots.setdefault(position, []).append((len(self._parts), format))
+        self._parts.append(format(self.schema[position].value))
+
+    def _compile_nml(self, params):
+        # the same grouping as _to_str_nml (and Namelist.dump), with positions
+        groups = odict()
+        positions = ((k, p) for k, p in enumerate(params))
+        for g, items in groupby(positions, lambda x: x[1].group):
+            if g == "":
+                raise ValueError("Group not defined. Cannot write to namelist. See Parameters' set_group() method.")
+            groups[g] = odict([(p.name, k) for k, p in items])
+        for g, variables in groups.items():
+            self._literal("&%s\n" % g)
+            for name, k in variables.items():
+                self._literal("  %s = " % name)
+                self._slot(k, _format_nml)
+                self._literal("\n")
+            self._literal("/\n")
+            self._literal("\n")
+        if self._parts:
+            self._parts.pop()  # no separator after the last group
+
+    def _compile_alex(self, params):
+        for k, p in enumerate(params):
+            if k: self._literal("\n")
+            if p.line:
+                self._literal("{} ".format(p.line))
+            else:
+                line = "{p.name} - {p.desc} ({p.units})".format(p=p)
+                self._literal("{line:39} = ".format(line=line))
+            self._slot(k, _format_alex)
+
+    def _compile_climber2(self, params):
+        for k, p in enumerate(params):
+            if k: self._literal("\n")
+            line = p.line or "{p.name} : {p.desc} ({p.units})".format(p=p)
+            self._literal(" ")
+            self._slot(k, _format_climber2)
+            self._literal("| {}".format(line))
+
+    def render(self, changes=()):
+        " text of the file, with changes: (schema position, value) pairs "
+        if not changes:
+            return "".join(self._parts)
+        parts = list(self._parts)
+        for k, value in changes:
+            for i, format in self._slots.get(k, ()):
+                parts[i] = format(value)
+        return "".join(parts)
+
+    def write_members(self, table, filenames, verbose=False, chunk=256):
+        """ write the members of a ParameterTable to files, one per member
+        (missing directories are created). The files are rendered by chunks, 
+        and each one is written with a single system call. 
+        Returns the file names.
+        """
+        filenames = list(filenames)
+        if len(filenames) != len(table):
+            raise ValueError("{} file names for {} members".format(len(filenames), len(table)))
+        folders = set()
+        with instrument.phase("write.members", format=self.format, files=len(filenames)):
+            for start in xrange(0, len(filenames), chunk):
+                texts = [self.render(table.changes(i)) for i in xrange(start, min(start+chunk, len(filenames)))]
+                for filename, text in zip(filenames[start:start+chunk], texts):
+                    folder = os.path.dirname(filename)
+                    if folder and folder not in folders:
+                        if not os.path.isdir(folder):
+                            os.makedirs(folder)
+                        folders.add(folder)
+                    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+                    try:
+                        os.write(fd, text)
+                    finally:
+                        os.close(fd)
+                    instrument.count("bytes_written", len(text))
+                    if verbose: print "Write params to {}".format(filename)
+        instrument.count("files_written", len(filenames))
+        return filenames
+
+
 if __name__ == "__main__":
     print "Test read namelist"
     params1 = Parameters.read_alex("examples/options_rembo")
@@ -0,0 +1,175 @@
+""" Registry of model runs, in a local SQLite database
+
+Each run is stored with its folder, executable, code checksum and status,
+and its parameter changes with respect to the defaults, one row per
+parameter (module, name, value). Numeric values are also stored as numbers,
+so that 1.2 and 1.20 match. Runs can then be queried by parameter values,
+without reading the parameter files of each folder.
+
+Usage:
+    registry.py [--db=<file>] [--status=<status>] [<name=value>...]
+
+Options:
+    -h --help           Show this screen
+    --db=<file>         registry database [default: runs.db]
+    --status=<status>   only list runs with that status (e.g. done, failed)
+
+Prints the folders of the runs matching all conditions, one per line.
+Parameter names can be qualified by their module, e.g. rembo:pdd_factor=1.2
+
+Examples
+--------
+>>> register("runs.db", "output/run1/", [("rembo", "pdd_factor", "1.2")], executable="sico.x")
+>>> set_status("runs.db", "output/run1/", "done")
+>>> find("runs.db", [("pdd_factor", 1.2), ("C_SLIDE_0", 10)])
+['output/run1/']
+"""
+import sqlite3
+import time
+import sys
+
+REGISTRY = 'runs.db'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    folder TEXT UNIQUE NOT NULL,
+    executable TEXT,
+    checksum TEXT,
+    status TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS params (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    module TEXT,
+    name TEXT NOT NULL,
+    value TEXT,
+    num REAL
+);
+CREATE INDEX IF NOT EXISTS params_value ON params (name, value, run);
+CREATE INDEX IF NOT EXISTS params_num ON params (name, num, run);
+CREATE INDEX IF NOT EXISTS params_run ON params (run);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+"""
+
+def connect(db=REGISTRY):
+    " open the registry, create it if needed "
+    # several processes may write at the same time (e.g. job -j)
+    con = sqlite3.connect(db, timeout=60)
+    con.text_factory = str
+    con.executescript(_schema)
+    return con
+
+def _number(value):
+    " numeric value of a parameter, or None "
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(str(value).replace('d', 'e').replace('D', 'e'))
+    except ValueError:
+        return None
+
+def register(db, folder, params=(), executable=None, checksum=None, status=None):
+    """ Add a run to the registry, or replace it if the folder is already there
+
+    params : (module, name, value) for each parameter changed from the defaults
+    """
+    now = time.time()
+    con = connect(db)
+    try:
+        with con:
+            row = con.execute("SELECT id, created FROM runs WHERE folder = ?", (folder,)).fetchone()
+            if row is None:
+                cur = con.execute("INSERT INTO runs (folder, executable, checksum, status, created, updated)"
+                                  " VALUES (?, ?, ?, ?, ?, ?)", (folder, executable, checksum, status, now, now))
+                run = cur.lastrowid
+            else:
+                run = row[0]
+                con.execute("UPDATE runs SET executable = ?, checksum = ?, status = ?, updated = ? WHERE id = ?",
+                            (executable, checksum, status, now, run))
+                con.execute("DELETE FROM params WHERE run = ?", (run,))
+            con.executemany("INSERT INTO params (run, module, name, value, num) VALUES (?, ?, ?, ?, ?)",
+                            [(run, module, name, str(value), _number(value)) for module, name, value in params])
+    finally:
+        con.close()
+
+def set_status(db, folder, status):
+    " update the status of one run, or of several runs if folder is a dict folder ==> status "
+    if not isinstance(folder, dict):
+        folder = {folder: status}
+    now = time.time()
+    con = connect(db)
+    try:
+        with con:
+            con.executemany("UPDATE runs SET status = ?, updated = ? WHERE folder = ?",
+                            [(s, now, f) for f, s in folder.iteritems()])
+    finally:
+        con.close()
+
+def find(db, conditions=(), status=None):
+    """ Return the folders of the runs matching all conditions, in registration order
+
+    conditions : (name, value) pairs, name may be written module:name
+    status : only runs with that status
+    """
+    query = ["SELECT folder FROM runs WHERE 1"]
+    args = []
+    for name, value in conditions:
+        module, _, name = name.rpartition(":")
+        num = _number(value)
+        if num is not None:
+            sub = "SELECT run FROM params WHERE name = ? AND num = ?"
+            subargs = [name, num]
+        else:
+            sub = "SELECT run FROM params WHERE name = ? AND value = ?"
+            subargs = [name, str(value)]
+        if module:
+            sub += " AND module = ?"
+            subargs.append(module)
+        query.append("AND id IN ({})".format(sub))
+        args.extend(subargs)
+    if status is not None:
+        query.append("AND status = ?")
+        args.append(status)
+    query.append("ORDER BY id")
+
+    con = connect(db)
+    try:
+        return [row[0] for row in con.execute(" ".join(query), args)]
+    finally:
+        con.close()
+
+def get(db, folder):
+    """ Return the registry entry of a run as a dict, with its parameters
+    as a list of (module, name, value), or None if not registered
+    """
+    con = connect(db)
+    try:
+        con.row_factory = sqlite3.Row
+        row = con.execute("SELECT * FROM runs WHERE folder = ?", (folder,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(row.keys(), row))
+        entry['params'] = [tuple(p) for p in con.execute(
+            "SELECT module, name, value FROM params WHERE run = ? ORDER BY rowid", (row['id'],))]
+        return entry
+    finally:
+        con.close()
+
+
+def main(argv=None):
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv)
+    conditions = []
+    for cond in args['<name=value>']:
+        name, sep, value = cond.partition("=")
+        if not sep:
+            print "Error: condition must be written name=value: "+cond
+            sys.exit(2)
+        conditions.append((name.strip(), value.strip()))
+    for folder in find(args['--db'], conditions, status=args['--status']):
+        print folder
+
+if __name__ == "__main__":
+    main()
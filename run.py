@@ -3,11 +3,13 @@
 This includes in particular reading and writing namelist files
 
 Usage:
-    run.py [--glacier=<name>] [--years=<years>] [(--continue | --reset)] [--over] [--params=<params> [--write-params] ] [--exe=<main.exe>] [--dry-run]
+    run.py [(--glacier=<name> | --glaciers=<names> | --all)] [--years=<years>] [(--continue | --reset)] [--over] [--params=<params> [--write-params] ] [--exe=<main.exe>] [--dry-run] [--registry=<db>] [--segments=<n>] [--jobs=<n>] [--rundir=<dir>] [--trace=<file>]
 
 Options:
     -h --help           Show this screen
     --glacier=<name>    glacier name
+    --glaciers=<names>  run several glaciers in parallel, e.g. --glaciers=a,b,c
+    --all               run all glaciers of the input directory in parallel
     --params=<params>   update glacier parameters
                         e.g. --params='{"submelt":{"cal_melt":100,"scal":1}}'
     -w --write-params   Make parameter changes persistent (always true for control)
@@ -17,6 +19,11 @@ Options:
     --reset             Restart from restart in input directory
     --exe=<main.exe>    Executable [default: ./main.exe ]
     --dry-run           Only update the namelists, do not execute the program
+    --registry=<db>     Record the run in this registry, none if empty (see registry.py) [default: runs.db]
+    --segments=<n>      Run n segments back-to-back (see below)
+    --jobs=<n>          Number of glaciers running at the same time (default: cores)
+    --rundir=<dir>      Run directories of the glaciers [default: runs]
+    --trace=<file>      Record the timing of each step in this file (see instrument.py)
 
 Continue a previous simulation with --continue:
     - Read restart from out directory
@@ -24,133 +31,340 @@ Continue a previous simulation with --continue:
     - Append to the output file (unless the --over flag is also set)
     to continue after the previous restart.
 Otherwise keep the restart file as it was.
+
+Run a chain of simulations with --segments N:
+    - the first segment is set up as usual (with --continue, --years etc.)
+    - each next segment continues the previous one, as with --continue
+    Progress is recorded in segments.json: if the chain is interrupted, or
+    a segment fails, the same command resumes the chain at the first
+    segment which did not complete.
+
+Run several glaciers with --glaciers or --all:
+    Each glacier gets its own run directory <rundir>/<glacier>/, with its own
+    control.nml and out/ directory (and a link to the input directory), so 
+    that the glaciers can run at the same time. Its control.nml is taken
+    from the run directory if present (e.g. to --continue), and from the
+    working directory otherwise. The glaciers run in a pool of --jobs
+    processes, the output of each is written to out.out and out.err in its
+    run directory, and the exit codes to <rundir>/batch.status.
+    (not available with --segments)
+
+Time spent reading and writing namelists, checking the code revision,
+updating the registry and running the model is recorded with --trace
+(or the environment variable RUN_TRACE), in the Chrome trace format,
+and summarized at the end (also with: python instrument.py <file>).
+
+The namelist files are edited in place: comments and formatting are kept,
+only the values which change are rewritten, and files whose content does
+not change are not written at all.
 """
 import subprocess
 from collections import OrderedDict
-from namelist import read_namelist_file
-import sys, os, docopt, json
+from namelist import read_namelist_file, read_namelist_document, NamelistDocument
+from parameters import Parameters
+import registry
+import scheduler
+import instrument
+import sys, os, docopt, json, struct, copy
 
 NML_CONTROL = 'control.nml'
 NML_DEFAULTS = 'params.nml'
 NML_UPDATE = 'input/{glacier}/update.nml'
 NML_GLACIER = 'input/{glacier}/input.nml'
+SEGMENTS_FILE = 'segments.json'
+
+# code checksum of a batch, passed to its members (see get_checksum)
+CHECKSUM_ENV = 'RUN_CHECKSUM'
 
 
 #
 # Here model-specific functions
 #
 def get_glacier_name():
-    " get glacier name from control "
-    control = read_namelist_file(NML_CONTROL)
-    return control.groups['general']['name']
+    " get glacier name from control (only the general group is parsed, the last name wins) "
+    with Parameters.read_nml(NML_CONTROL, verbose=False, lazy=True) as control:
+        return control.filter(name='name', group='general')[-1].value
     
 
+def _git_dir(codedir):
+    " the .git directory of codedir (also for worktrees), or None "
+    gitdir = os.path.join(codedir, '.git')
+    if os.path.isfile(gitdir):
+        line = open(gitdir).read().strip()
+        if line.startswith('gitdir:'):
+            gitdir = os.path.join(codedir, line[len('gitdir:'):].strip())
+    return gitdir if os.path.isdir(gitdir) else None
+
+def _git_head(gitdir):
+    " commit of HEAD, read from .git/HEAD and the refs (empty string if none) "
+    head = open(os.path.join(gitdir, 'HEAD')).read().strip()
+    if not head.startswith('ref:'):
+        return head # detached HEAD
+    ref = head[len('ref:'):].strip()
+    # worktrees keep their refs in the main repository
+    commondir = gitdir
+    if os.path.isfile(os.path.join(gitdir, 'commondir')):
+        commondir = os.path.join(gitdir, open(os.path.join(gitdir, 'commondir')).read().strip())
+    for d in (gitdir, commondir):
+        if os.path.isfile(os.path.join(d, ref)):
+            return open(os.path.join(d, ref)).read().strip()
+    packed = os.path.join(commondir, 'packed-refs')
+    if os.path.isfile(packed):
+        for line in open(packed):
+            if line.rstrip().endswith(' '+ref):
+                return line.split()[0]
+    return "" # no commit yet
+
+def _git_dirty(codedir, gitdir):
+    """ True if a tracked file changed since it was last staged or committed:
+    its mtime or size differs from the one recorded in the index
+    (files only touched are also counted, as does git before refreshing)
+    """
+    index = os.path.join(gitdir, 'index')
+    if not os.path.isfile(index):
+        return False
+    data = open(index, 'rb').read()
+    signature, version, n = struct.unpack('>4sLL', data[:12])
+    if signature != 'DIRC' or version not in (2, 3):
+        # unknown index format: ask git
+        cmd = ['git', '-C', codedir, 'status', '--porcelain', '--untracked-files=no']
+        return subprocess.check_output(cmd) != ""
+    pos = 12
+    for _ in xrange(n):
+        mtime, mtime_ns = struct.unpack('>LL', data[pos+8:pos+16])
+        size, = struct.unpack('>L', data[pos+36:pos+40])
+        flags, = struct.unpack('>H', data[pos+60:pos+62])
+        start = pos + 62
+        if flags & 0x4000: # extended flags (version 3)
+            start += 2
+        end = data.index('\0', start)
+        path = data[start:end]
+        pos += (end - pos + 8) // 8 * 8 # entries are padded to 8 bytes
+        try:
+            st = os.lstat(os.path.join(codedir, path))
+        except OSError:
+            return True # deleted
+        if int(st.st_mtime) != mtime or (st.st_size & 0xffffffff) != size:
+            return True
+    return False
+
+@instrument.timed("checksum")
 def get_checksum(codedir='./', safe=True):
-    """ return git's checksum
+    """ return git's checksum: the commit of HEAD, with a -dirty suffix
+    if tracked files were modified (empty string if codedir is not a
+    git repository)
+
+    Git is not called: HEAD and the index are read directly, and the tracked
+    files are compared to the index at each call (one stat each), since
+    editing a file changes neither HEAD nor the index. A batch can also
+    resolve it once and pass it to its members in the RUN_CHECKSUM
+    environment variable, which is then returned as is.
+
+    With safe=True, ask for confirmation if the directory is not clean
+    (only if there is a terminal to ask: otherwise just print a warning).
     """
-    cmd = 'cd {codedir} && git log | head -1 | sed "s/commit //"'.format(codedir=codedir)
-    commit = subprocess.check_output(cmd, shell=True)
-
-    if safe:
-        cmd = 'cd {codedir} && git status | grep "Changes.*commit" \
-            || dummy_command_to_avoid_error=1'.format(codedir=codedir)
-        # cmd = 'cd {codedir} && echo $status | grep "Changes.*commit"'.format(codedir=codedir)
-        changes = subprocess.check_output(cmd, shell=True)
-        if changes != "":
-            cmd = 'cd {codedir} && git status'.format(codedir=codedir)
-            os.system(cmd)
-            y = raw_input("git directory not clean, proceed? (press 'y') ")
+    if os.environ.get(CHECKSUM_ENV):
+        return os.environ[CHECKSUM_ENV]
+
+    gitdir = _git_dir(codedir)
+    if gitdir is None:
+        return ""
+    head = _git_head(gitdir)
+    dirty = _git_dirty(codedir, gitdir)
+
+    if dirty and safe:
+        print "git directory not clean: "+os.path.abspath(codedir)
+        if sys.stdin.isatty():
+            y = raw_input("proceed? (press 'y') ")
             if y != 'y':
                 print "Stopped by user."
                 sys.exit()
 
-    return commit
+    return head + ("-dirty" if dirty else "")
 
 
-def main():
-    args = docopt.docopt(__doc__)
-    print args
-    control = read_namelist_file(NML_CONTROL)
+def continue_run(control):
+    """ set the control namelist to continue the previous simulation:
+    read restart from out directory, append output, next period of same length
+    """
+    dates = control.groups['time']
+    control.set('general', 'rst_dir', 'out')
+    control.set('output', 'out_mode', 'append')
+    # udpate simulation dates
+    duration = dates['yearf'] - dates['year0'] + 1
+    control.set('time', 'year0', dates['year0'] + duration)
+    control.set('time', 'yearf', dates['yearf'] + duration)
 
-    # check the glacier name
-    # if not provided, read in the control file
-    if args['--glacier'] is None:
-        glacier = control.groups['general']['name']
-    # otherwise, just take from the command line
-    else:
-        glacier = args['--glacier']
-        control.groups['general']['name'] = glacier
+def read_segments(glacier, segments, filename=SEGMENTS_FILE):
+    " return the progress of an unfinished chain of segments, or None "
+    try:
+        progress = json.load(open(filename))
+    except (IOError, ValueError):
+        return None
+    if progress['glacier'] != glacier or progress['segments'] != segments:
+        return None
+    if progress['segment'] == segments and progress['status'] == 'done':
+        return None # finished: start a new chain
+    return progress
 
-    #
-    # update glacier parameters
-    #
+def write_segments(filename=SEGMENTS_FILE, **progress):
+    " record the progress of a chain of segments (atomic write) "
+    with open(filename+'.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.rename(filename+'.tmp', filename)
+
+def run_segments(control, executable, glacier, segments, first=1, filename=SEGMENTS_FILE):
+    """ run the segments first..segments, the first one as set in control,
+    the next ones continuing the previous one. Only the changed control 
+    values are written between segments. Return the exit status.
+    """
+    dates = control.groups['time']
+    for segment in range(first, segments+1):
+        if segment > first:
+            continue_run(control)
+        if control.write(NML_CONTROL):
+            print "write ",NML_CONTROL
+
+        progress = dict(glacier=glacier, segments=segments, segment=segment,
+                        year0=dates['year0'], yearf=dates['yearf'])
+        write_segments(filename, status='running', **progress)
+        print "segment {}/{}: years {} to {}".format(segment, segments, dates['year0'], dates['yearf'])
+        instrument.count("subprocesses")
+        with instrument.phase("execute", segment=segment):
+            status = subprocess.call(executable, shell=True)
+        if status != 0:
+            write_segments(filename, status='failed', **progress)
+            print "segment {} failed (exit status {}), rerun to resume".format(segment, status)
+            return status
+        write_segments(filename, status='done', **progress)
+    return 0
+
+@instrument.timed()
+def update_params(glacier, params, args):
+    """ update the default parameters with the glacier-specific ones, and 
+    the command line ones, and write the glacier namelist.
+    Return the glacier-specific parameters.
+    """
     nml_update = NML_UPDATE.format(glacier=glacier)
     nml_glacier = NML_GLACIER.format(glacier=glacier)
 
-    params = read_namelist_file(NML_DEFAULTS) # default
-
     # glacier-specific parameters
     if os.path.isfile(nml_update):
-        specific = read_namelist_file(nml_update) 
+        specific = read_namelist_document(nml_update) 
     else:
-        specific = Namelist("")
+        specific = NamelistDocument("")
 
     # update from command line parameters?
     if args['--params']:
-        user=json.loads(args['--params'])
+        user=json.loads(args['--params'], object_pairs_hook=OrderedDict)
         print user
-        for group in user.keys():
-            if group not in specific.groups:
-                specific.groups[group] = OrderedDict()
-            specific.groups[group].update(user[group])
+        specific.update(user)
 
         # write user-input parameters to the glacier specifics?
         if args['--write-params']:
-            with open(nml_update,'w') as f:
-                f.write(specific.dump())
+            if specific.write(nml_update):
+                print "write namelist to",nml_update
 
     # update defaults
-    for group in specific.groups:
-        params.groups[group].update(specific.groups[group])
+    params.update(specific.groups)
 
     # write down the updated glacier namelist
-    print "write namelist to",nml_glacier
-    with open(nml_glacier,'w') as f:
-        f.write(params.dump())
+    if params.write(nml_glacier):
+        print "write namelist to",nml_glacier
+    else:
+        print "unchanged",nml_glacier
 
-    #
-    # update control namelist
-    #
+    return specific
+
+def update_control(control, args):
+    " update the control namelist from the command line options "
+    dates = control.groups['time']
 
     # continue previous simulation?
     if args['--continue']:
-        control.groups['general']['rst_dir'] = 'out'
-        control.groups['output']['out_mode'] = 'append'
-        # udpate simulation dates
-        duration = control.groups['time']['yearf'] - control.groups['time']['year0'] + 1
-        control.groups['time']['year0'] += duration
-        control.groups['time']['yearf'] += duration
+        continue_run(control)
 
     # reset to restart present in input dir
     elif args['--reset']:
-        control.groups['general']['rst_dir'] = 'input'
-        control.groups['output']['out_mode'] = 'overwrite'
-        duration = control.groups['time']['yearf'] - control.groups['time']['year0'] + 1
-        control.groups['time']['year0'] = 0
-        control.groups['time']['yearf'] = duration-1
+        control.set('general', 'rst_dir', 'input')
+        control.set('output', 'out_mode', 'overwrite')
+        duration = dates['yearf'] - dates['year0'] + 1
+        control.set('time', 'year0', 0)
+        control.set('time', 'yearf', duration-1)
 
     # overwrite the output (instead of append mode)
     if args['--over']:
-        control.groups['output']['out_mode'] = 'overwrite'
+        control.set('output', 'out_mode', 'overwrite')
 
     # number of years of simulation
     if args['--years']:
-        control.groups['time']['yearf'] = control.groups['time']['year0'] + int(args['--years']) - 1
+        control.set('time', 'yearf', dates['year0'] + int(args['--years']) - 1)
+
+def glacier_diff(glacier, specific):
+    " parameters of a glacier for the registry "
+    diff = [(group, name, specific.groups[group][name]) 
+            for group in specific.groups for name in specific.groups[group]]
+    diff.append(('general', 'name', glacier))
+    return diff
+
+def main():
+    args = docopt.docopt(__doc__)
+    print args
+    if args['--trace']:
+        instrument.start(args['--trace'])
+    try:
+        if args['--glaciers'] or args['--all']:
+            return run_glaciers(args)
+        return run_glacier(args)
+    finally:
+        if args['--trace']:
+            instrument.report()
+
+def run_glacier(args):
+    " set up and run one glacier in the working directory "
+
+    control = read_namelist_document(NML_CONTROL)
+
+    # check the glacier name
+    # if not provided, read in the control file
+    if args['--glacier'] is None:
+        glacier = control.groups['general']['name']
+    # otherwise, just take from the command line
+    else:
+        glacier = args['--glacier']
+        control.set('general', 'name', glacier)
+
+    #
+    # update glacier parameters
+    #
+    params = read_namelist_document(NML_DEFAULTS) # default
+    specific = update_params(glacier, params, args)
+
+    #
+    # update control namelist
+    #
+    segments = int(args['--segments']) if args['--segments'] else None
+    progress = segments and read_segments(glacier, segments)
+    first = 1
+
+    # resume an interrupted chain of segments?
+    if progress:
+        first = progress['segment']
+        control.set('time', 'year0', progress['year0'])
+        control.set('time', 'yearf', progress['yearf'])
+        if progress['status'] == 'done':
+            first += 1
+            continue_run(control)
+        elif first > 1:
+            control.set('general', 'rst_dir', 'out')
+            control.set('output', 'out_mode', 'append')
+        print "resume segment {}/{}".format(first, segments)
+    else:
+        update_control(control, args)
 
     # write the control file to disk
-    print "write ",NML_CONTROL
-    with open(NML_CONTROL,'w') as f:
-        f.write(control.dump())
+    if control.write(NML_CONTROL):
+        print "write ",NML_CONTROL
 
     if args['--dry-run']:
         # sys.exit()
@@ -162,8 +376,100 @@ def main():
         executable = args['--exe']
         #"./main.exe"
 
+    # record the run and its glacier-specific parameters in the registry,
+    # under its output folder (several runs may start from the same directory)
+    db = args['--registry'] or None
+    folder = os.path.abspath(control.groups['general'].get('out_dir', 'out'))
+    if db is not None:
+        checksum = get_checksum(safe=False).strip()
+        with instrument.phase("registry"):
+            registry.register(db, folder, glacier_diff(glacier, specific), executable=executable, 
+                              checksum=checksum, status='running')
+
     # execute the fortran script
-    os.system(executable)
+    if segments:
+        status = run_segments(control, executable, glacier, segments, first)
+    else:
+        instrument.count("subprocesses")
+        with instrument.phase("execute"):
+            status = os.system(executable)
+    if db is not None:
+        with instrument.phase("registry"):
+            registry.set_status(db, folder, 'done' if status == 0 else 'failed')
+
+def run_glaciers(args):
+    " set up and run several glaciers in parallel, each in its own run directory "
+    if args['--segments']:
+        print "Error: --segments cannot be used with several glaciers"
+        sys.exit(2)
+
+    if args['--all']:
+        indir = os.path.dirname(NML_GLACIER.format(glacier=''))
+        glaciers = sorted(g for g in os.listdir(indir) if os.path.isdir(os.path.join(indir, g)))
+    else:
+        glaciers = [g.strip() for g in args['--glaciers'].split(',') if g.strip()]
+
+    rundir = args['--rundir']
+    db = args['--registry'] or None
+    executable = os.path.abspath(args['--exe'].strip())
+    checksum = get_checksum(safe=False).strip()
+    os.environ[CHECKSUM_ENV] = checksum # for the glacier runs
+
+    # the defaults are read only once
+    defaults = read_namelist_document(NML_DEFAULTS)
+    control0 = read_namelist_document(NML_CONTROL)
+
+    folders = []
+    for glacier in glaciers:
+        print "====", glacier
+        params = copy.deepcopy(defaults)
+        specific = update_params(glacier, params, args)
+
+        # private run directory, with a link to the input directory
+        folder = os.path.join(rundir, glacier) + '/'
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        in_dir = control0.groups['general'].get('in_dir', 'input')
+        if not os.path.lexists(os.path.join(folder, in_dir)):
+            os.symlink(os.path.abspath(in_dir), os.path.join(folder, in_dir))
+
+        # its own control namelist, continued from the previous run if any
+        if os.path.isfile(folder + NML_CONTROL):
+            control = read_namelist_document(folder + NML_CONTROL)
+        else:
+            control = copy.deepcopy(control0)
+        control.set('general', 'name', glacier)
+        update_control(control, args)
+        out_dir = os.path.join(folder, control.groups['general'].get('out_dir', 'out'))
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        if control.write(folder + NML_CONTROL):
+            print "write ",folder + NML_CONTROL
+
+        if not args['--dry-run'] and db is not None:
+            with instrument.phase("registry"):
+                registry.register(db, os.path.abspath(folder), glacier_diff(glacier, specific), 
+                                  executable=executable, checksum=checksum, status='queued')
+        folders.append(folder)
+
+    if args['--dry-run']:
+        return
+
+    # each invocation is a new run of all glaciers
+    status_file = os.path.join(rundir, scheduler.STATUS_FILE)
+    if os.path.isfile(status_file):
+        os.remove(status_file)
+    nproc = int(args['--jobs']) if args['--jobs'] else None
+    with instrument.phase("execute", glaciers=len(folders)):
+        status = scheduler.run([(folder, [executable]) for folder in folders], nproc=nproc,
+                               status_file=status_file, chdir=True)
+
+    if db is not None:
+        registry.set_status(db, dict((os.path.abspath(folder), scheduler.state(record)) 
+                                     for folder, record in status.iteritems()), None)
+    print "Exit codes (logs in {}<glacier>/out.out):".format(os.path.join(rundir, ''))
+    for glacier, folder in zip(glaciers, folders):
+        print "  {:<20} {}".format(glacier, status[folder].get('exit'))
 
 if __name__ == "__main__":
     main()
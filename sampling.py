@@ -0,0 +1,138 @@
+""" Space-filling designs for parameter ensembles (requires numpy)
+
+Each method returns a design matrix of n members (rows) in the unit
+hypercube of d dimensions (columns), generated at once with array
+operations, and scaled to the parameter ranges with scale().
+
+    random  : independent uniform samples
+    lhs     : Latin hypercube (each parameter range is cut into n intervals
+              of equal probability, each of which is sampled once)
+    halton  : Halton sequence (low discrepancy), up to 100 parameters
+    sobol   : Sobol sequence (low discrepancy), up to 16 parameters
+
+random and lhs depend on the seed, halton and sobol are deterministic
+(their first point, which lies on the corner of the hypercube, is skipped).
+
+Examples
+--------
+>>> u = design("lhs", 100, 2, seed=1)
+>>> x = scale(u, [0.5, 5], [1.5, 15])
+>>> write_design("output/lhs/design.txt", ["pdd_factor", "C_SLIDE_0"], x)
+"""
+import numpy as np
+
+METHODS = ("lhs", "sobol", "halton", "random")
+
+def random(n, d, seed=0):
+    return np.random.RandomState(seed).uniform(size=(n, d))
+
+def lhs(n, d, seed=0):
+    rng = np.random.RandomState(seed)
+    # a random permutation of the n intervals for each parameter,
+    # and a random position within each interval
+    perm = np.argsort(rng.uniform(size=(n, d)), axis=0)
+    return (perm + rng.uniform(size=(n, d))) / n
+
+def _primes(d):
+    " the first d prime numbers "
+    primes = []
+    k = 2
+    while len(primes) < d:
+        if all(k % p for p in primes if p*p <= k):
+            primes.append(k)
+        k += 1
+    return np.array(primes)
+
+def halton(n, d, seed=None):
+    if d > 100:
+        raise ValueError("halton: at most 100 parameters")
+    bases = _primes(d)
+    index = np.arange(1, n+1)[:, None] * np.ones(d, dtype=int)  # skip 0
+    u = np.zeros((n, d))
+    factor = 1. / bases
+    # radical inverse, one digit of all indices at a time
+    while np.any(index > 0):
+        index, digit = index // bases, index % bases
+        u += digit * factor
+        factor = factor / bases
+    return u
+
+# Sobol direction numbers (Joe and Kuo, new-joe-kuo-6.21201) for dimensions 2..16:
+# (degree s, coefficients a, initial direction numbers m)
+_SOBOL = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+]
+_BITS = 30
+
+def _directions(d):
+    " direction numbers V[dimension, bit], as integers scaled by 2**_BITS "
+    V = np.zeros((d, _BITS), dtype=np.int64)
+    V[0] = 1 << np.arange(_BITS-1, -1, -1)  # first dimension: van der Corput
+    for j in range(1, d):
+        s, a, m = _SOBOL[j-1]
+        v = [m[k] << (_BITS-1-k) for k in range(s)]
+        for k in range(s, _BITS):
+            x = v[k-s] ^ (v[k-s] >> s)
+            for i in range(1, s):
+                x ^= ((a >> (s-1-i)) & 1) * v[k-i]
+            v.append(x)
+        V[j] = v
+    return V
+
+def sobol(n, d, seed=None):
+    if d > len(_SOBOL) + 1:
+        raise ValueError("sobol: at most {} parameters".format(len(_SOBOL)+1))
+    V = _directions(d)
+    index = np.arange(1, n+1, dtype=np.int64)  # skip 0
+    gray = index ^ (index >> 1)
+    X = np.zeros((n, d), dtype=np.int64)
+    # X = XOR of the direction numbers of the bits of the Gray code
+    for b in range(_BITS):
+        bit = (gray >> b) & 1
+        if not bit.any():
+            break
+        X ^= bit[:, None] * V[:, b]
+    return X / float(1 << _BITS)
+
+def design(method, n, d, seed=0):
+    " design matrix (n, d) in the unit hypercube "
+    if method not in METHODS:
+        raise ValueError("unknown sampling method: {} (one of {})".format(method, ", ".join(METHODS)))
+    return globals()[method](n, d, seed=seed)
+
+def scale(u, lo, hi):
+    " scale a design in the unit hypercube to the ranges [lo, hi] of each column "
+    lo = np.asarray(lo, dtype=float)
+    hi = np.asarray(hi, dtype=float)
+    return lo + u * (hi - lo)
+
+def format_values(x, digits=6):
+    " values of the design as strings (rows of the parameter values) "
+    fmt = "%.{}g".format(digits)
+    return np.char.mod(fmt, x)
+
+def write_design(filename, names, values, folders=None):
+    """ write the design to a text file, one member per line:
+    member number, [folder,] parameter values (as used in the jobs)
+    """
+    values = np.asarray(values)
+    header = ["member"] + (["folder"] if folders is not None else []) + list(names)
+    with open(filename, "w") as f:
+        f.write(" ".join(header) + "\n")
+        for i, row in enumerate(values):
+            cols = [str(i)] + ([folders[i]] if folders is not None else []) + [str(v) for v in row]
+            f.write(" ".join(cols) + "\n")
@@ -0,0 +1,252 @@
+""" Local run scheduler
+
+Run prepared model runs on the local machine, with a bounded number of
+concurrent processes, and record the start time, end time, exit code and
+peak memory (RSS) of each run in a status file, one JSON record per line.
+
+The status file makes a batch resumable: issuing the same batch again
+skips the runs which completed successfully, and waits for the runs which
+were started by a previous (killed) scheduler and are still going. Their
+process is recognised by its pid and start time (so that a new process
+with the same pid is not mistaken for the run); those which ended in the
+meantime are recorded as lost.
+
+Runs can also be identified by a key, e.g. a hash of their input files:
+the exit code of each keyed run is then recorded in a cache file, and a 
+run is skipped if a run with the same key completed successfully, and 
+its folder still exists (whatever the status file says about the folder).
+
+Examples
+--------
+>>> runs = [("output/run1/", ["./sico.x", "output/run1/"])]
+>>> run(runs, nproc=4, status_file="output/batch.status")
+>>> summary("output/batch.status")
+"""
+from collections import OrderedDict
+import multiprocessing
+import subprocess
+import errno
+import json
+import time
+import sys
+import os
+
+import instrument
+
+STATUS_FILE = 'batch.status'
+CACHE_FILE = 'run.cache'
+
+def read_status(status_file):
+    """ return the current status of each run in the status file,
+    as an ordered dict: run folder ==> merged record
+    """
+    status = OrderedDict()
+    if not os.path.isfile(status_file):
+        return status
+    with open(status_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # partially written line from a killed scheduler
+            status.setdefault(record['run'], {}).update(record)
+    return status
+
+def summary(status_file):
+    " count the runs in the status file by state "
+    counts = OrderedDict([('running', 0), ('done', 0), ('failed', 0), ('lost', 0)])
+    for record in read_status(status_file).itervalues():
+        counts[state(record)] += 1
+    return counts
+
+def state(record):
+    """ state of a run from its status record: 'running', 'done', 'failed',
+    or 'lost' if it ended with an unknown exit code (started by a previous
+    scheduler, which could not wait for it)
+    """
+    if 'exit' not in record:
+        return 'running'
+    if record['exit'] is None:
+        return 'lost'
+    return 'done' if record['exit'] == 0 else 'failed'
+
+def read_cache(cache_file):
+    """ return the last cache record of each key in the cache file,
+    as a dict: key ==> {'hash': key, 'run': run folder, 'exit': exit code}
+    """
+    cache = {}
+    if not os.path.isfile(cache_file):
+        return cache
+    with open(cache_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            cache[record['hash']] = record
+    return cache
+
+def completed(cache, key):
+    " True if the run with that key completed successfully and its folder exists "
+    record = cache.get(key)
+    return record is not None and record['exit'] == 0 and os.path.isdir(record['run'])
+
+def _alive(pid):
+    " True if process pid exists "
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+def _started(pid):
+    """ start time of process pid, in clock ticks since boot (None if
+    unknown: no /proc, or no such process)
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # the fields after the command name, which may contain spaces
+    return int(stat[stat.rindex(")")+2:].split()[19])
+
+def _running(pid, started):
+    " True if process pid is still the one which started at that time (if known) "
+    if not _alive(pid):
+        return False
+    return started is None or _started(pid) in (None, started)
+
+def _write(log, **record):
+    log.write(json.dumps(record)+"\n")
+    log.flush()
+
+def launch(fldr, cmd, out="out.out", err="out.err", cwd=None):
+    " start cmd in the background, with its output to the run folder "
+    stdout = open(os.path.join(fldr, out), 'w')
+    stderr = open(os.path.join(fldr, err), 'w')
+    instrument.count("subprocesses")
+    try:
+        with instrument.phase("launch", folder=fldr):
+            return subprocess.Popen(cmd, stdout=stdout, stderr=stderr, close_fds=True, cwd=cwd)
+    finally:
+        stdout.close()
+        stderr.close()
+
+def run(runs, nproc=None, status_file=STATUS_FILE, cache_file=None, chdir=False, poll=0.5, verbose=True):
+    """ Run all runs, at most nproc at a time (default: number of cores)
+
+    runs : iterable of (run folder, command) pairs, or (run folder, command, key),
+        consumed lazily as processes finish, so that runs can be prepared 
+        while others go.
+    status_file : status records are appended to that file
+    cache_file : exit codes of keyed runs are appended to that file 
+        (default: CACHE_FILE next to status_file)
+    chdir : if True, run each command in its run folder
+    poll : time interval (s) to check on runs when none has finished
+
+    Returns the status of all runs in the status file (see read_status).
+    """
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    status = read_status(status_file)
+    fldr = os.path.dirname(status_file)
+    if fldr and not os.path.isdir(fldr):
+        os.makedirs(fldr)
+    if cache_file is None:
+        cache_file = os.path.join(fldr, CACHE_FILE)
+    cache = read_cache(cache_file)
+    log = open(status_file, 'a')
+    cachelog = None
+
+    running = {}  # pid ==> (run folder, process, key, start), for runs started here
+    orphans = {}  # pid ==> (run folder, process start time), started by a previous scheduler
+    for fldr, record in status.iteritems():
+        if state(record) != 'running':
+            continue
+        if _running(record['pid'], record.get('started')):
+            orphans[record['pid']] = (fldr, record.get('started'))
+        else:
+            # ended while no scheduler was waiting for it
+            record.update(end=time.time(), exit=None)
+            _write(log, run=fldr, end=record['end'], exit=None)
+            if verbose: print "Lost {} (exit code unknown)".format(fldr)
+    waiting = set(fldr for fldr, _ in orphans.itervalues())
+
+    runs = iter(runs)
+    pending = True
+    try:
+        while True:
+            # start new runs as long as there are free slots
+            while pending and len(running) + len(orphans) < nproc:
+                try:
+                    item = next(runs)
+                except StopIteration:
+                    pending = False
+                    break
+                fldr, cmd = item[:2]
+                key = item[2] if len(item) > 2 else None
+                record = status.get(fldr, {})
+                if fldr in waiting:
+                    if verbose: print "Skip {} ({})".format(fldr, state(record))
+                    continue
+                if key is None and state(record) == 'done':
+                    if verbose: print "Skip {} (done)".format(fldr)
+                    continue
+                if key is not None and completed(cache, key):
+                    if verbose: print "Skip {} (done in {})".format(fldr, cache[key]['run'])
+                    continue
+                proc = launch(fldr, cmd, cwd=fldr if chdir else None)
+                start = time.time()
+                running[proc.pid] = (fldr, proc, key, start)
+                _write(log, run=fldr, cmd=cmd, pid=proc.pid, started=_started(proc.pid), start=start)
+                if verbose: print "Started {} (pid {})".format(fldr, proc.pid)
+
+            if not running and not orphans:
+                break
+
+            # collect finished runs (only our own: the caller may have other 
+            # child processes, e.g. a multiprocessing pool)
+            finished = False
+            for pid in running.keys():
+                pid, exit, rusage = os.wait4(pid, os.WNOHANG)
+                if pid == 0:
+                    continue
+                finished = True
+                fldr, proc, key, start = running.pop(pid)
+                code = os.WEXITSTATUS(exit) if os.WIFEXITED(exit) else -os.WTERMSIG(exit)
+                proc.returncode = code # reaped here, not by subprocess
+                end = time.time()
+                _write(log, run=fldr, end=end, exit=code, maxrss_kb=rusage.ru_maxrss)
+                instrument.record("run", start, end, folder=fldr, exit=code)
+                if key is not None:
+                    if cachelog is None:
+                        cachelog = open(cache_file, 'a')
+                    cache[key] = dict(hash=key, run=fldr, exit=code)
+                    _write(cachelog, **cache[key])
+                if verbose: print "Finished {} (exit code {})".format(fldr, code)
+
+            # runs of a previous scheduler cannot be waited for: their exit
+            # code is unknown, they have to be checked by other means
+            for pid in orphans.keys():
+                if not _running(pid, orphans[pid][1]):
+                    finished = True
+                    fldr = orphans.pop(pid)[0]
+                    _write(log, run=fldr, end=time.time(), exit=None)
+                    if verbose: print "Lost {} (exit code unknown)".format(fldr)
+
+            if not finished:
+                time.sleep(poll)
+    finally:
+        log.close()
+        if cachelog is not None:
+            cachelog.close()
+
+    return read_status(status_file)
+
+if __name__ == "__main__":
+    # print the summary of a status file
+    status_file = sys.argv[1] if len(sys.argv) > 1 else STATUS_FILE
+    for k, n in summary(status_file).iteritems():
+        print "{:<8} {}".format(k, n)
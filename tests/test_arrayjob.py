@@ -0,0 +1,150 @@
+""" Array job scripts, submitted with fake llsubmit and qsub commands
+
+    python -m unittest discover tests
+"""
+import subprocess
+import tempfile
+import unittest
+import shutil
+import imp
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import arrayjob
+import monitor
+import scheduler
+
+# fake model: writes the folder it was given (or runs in), fails in folder b
+MODEL = """#!/bin/sh
+dir=${1:-$PWD/}
+echo "$dir" > "$dir/ran"
+case "$dir" in */b/) exit 3;; esac
+"""
+
+LLSUBMIT = """#!/bin/sh
+echo "$1" >> submitted
+echo 'llsubmit: The job "iplex01.pik-potsdam.de.4321" with 3 job steps has been submitted.'
+"""
+
+QSUB = """#!/bin/sh
+echo "$1" >> submitted
+echo 'Your job-array 987.1-3:1 ("rembo_sico") has been submitted'
+"""
+
+def command(cmd):
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return proc.communicate()
+
+def _script(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.chmod(path, 0755)
+
+class TestArrayJob(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.user = os.environ.get('USER')
+        os.environ['USER'] = "user"
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        _script("model.x", MODEL)
+        _script("llsubmit", LLSUBMIT)
+        _script("qsub", QSUB)
+        self.batch = "output/runs/"
+        self.folders = [self.batch + name + "/" for name in ("a", "b", "c")]
+        for folder in self.folders:
+            os.makedirs(folder)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+        if self.user is None:
+            del os.environ['USER']
+        else:
+            os.environ['USER'] = self.user
+
+    def run_steps(self, queue):
+        " run each step (task) of the array script as the queue would, from another directory "
+        script = os.path.abspath(self.batch + arrayjob.JOBSCRIPT)
+        os.makedirs("elsewhere")
+        devnull = open(os.devnull, 'w')
+        for k in range(1, len(self.folders)+1):
+            if queue == "sge":
+                env = dict(os.environ, SGE_TASK_ID=str(k))
+                # the tasks run the copy of the model in their folder
+                shutil.copy("model.x", self.folders[k-1])
+                subprocess.call(["bash", script], env=env, cwd="elsewhere", stdout=devnull, stderr=devnull)
+            else:
+                # the steps start in the submission directory
+                subprocess.call(["sh", script, str(k)], stdout=devnull, stderr=devnull)
+
+    def check_folders(self):
+        for folder in self.folders:
+            with open(os.path.join(folder, "ran")) as f:
+                self.assertEqual(f.read().strip(), os.path.abspath(folder) + "/")
+
+    def test_listing(self):
+        text = arrayjob.listing(self.folders, ["k1", "k2", "k3"])
+        lines = text.splitlines()
+        self.assertEqual(lines[1], os.path.abspath(self.folders[1]) + "/ k2")
+        self.assertTrue(all(os.path.isabs(line) for line in lines))
+
+    def test_ll(self):
+        cachefile = self.batch + scheduler.CACHE_FILE
+        jobid = arrayjob.submit("model.x", self.folders, self.batch, 24, "./llsubmit", command,
+                                keys=["k1", "k2", "k3"], cachefile=cachefile)
+        self.assertEqual(jobid, "4321")
+        self.assertEqual(open("submitted").read().strip(), self.batch + arrayjob.JOBSCRIPT)
+        script = open(self.batch + arrayjob.JOBSCRIPT).read()
+        self.assertEqual(script.count("# @ queue"), 3)
+        self.assertIn("# @ output = %sout.out" % self.folders[2], script)
+
+        jobs = monitor.read_jobs(self.batch)
+        self.assertEqual([r['job'] for r in jobs.values()], ["4321.0", "4321.1", "4321.2"])
+
+        self.run_steps("ll")
+        self.check_folders()
+        cache = scheduler.read_cache(cachefile)
+        self.assertEqual(sorted((k, r['exit']) for k, r in cache.items()), [("k1", 0), ("k2", 3), ("k3", 0)])
+        self.assertEqual(cache["k1"]['run'], os.path.abspath(self.folders[0]) + "/")
+
+        # the monitor finds the exit codes of the steps which left the queue
+        self.assertEqual(monitor.finished(self.folders[1], dict((os.path.abspath(r['run']), r['exit'])
+                                                                for r in cache.values())), 'failed')
+
+    def test_sge(self):
+        jobid = arrayjob.submit("model.x", self.folders, self.batch, 24, "./qsub", command, queue="sge")
+        self.assertEqual(jobid, "987")
+        script = open(self.batch + arrayjob.JOBSCRIPT).read()
+        self.assertIn("#$ -t 1-3 ", script)
+        jobs = monitor.read_jobs(self.batch)
+        self.assertEqual([(r['job'], r['queue']) for r in jobs.values()],
+                         [("987.1", "sge"), ("987.2", "sge"), ("987.3", "sge")])
+        self.run_steps("sge")
+        self.check_folders()
+
+    def test_job(self):
+        " job's --array submission, with llsubmit replaced through $LLSUBMIT "
+        os.environ['LLSUBMIT'] = "./llsubmit"
+        try:
+            job = imp.load_source("job_under_test", os.path.join(ROOT, "job"))
+        finally:
+            del os.environ['LLSUBMIT']
+            if os.path.isfile(os.path.join(ROOT, "jobc")):
+                os.remove(os.path.join(ROOT, "jobc"))
+        self.assertEqual(job.llsubmit, "./llsubmit")
+        _script("rembo.x", MODEL)
+        for folder in self.folders:
+            open(folder + "options_rembo", 'w').write(folder)  # hashed in the key of the run
+        job.submit_array("rembo.x", self.folders, self.batch, 24, "")
+        self.assertIn("./rembo.x $outfldr", open(self.batch + arrayjob.JOBSCRIPT).read())
+        self.run_steps("ll")
+        self.check_folders()
+        self.assertEqual(len(scheduler.read_cache(self.batch + scheduler.CACHE_FILE)), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+""" Persistent cache of parsed files
+
+    python -m unittest discover tests
+"""
+import tempfile
+import unittest
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cache
+
+calls = []
+
+def parse(text):
+    calls.append(text)
+    return text.split()
+
+def parse_upper(text):
+    calls.append(text)
+    return text.upper().split()
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.settings = cache.DIRECTORY, cache.RACY, cache.TOUCH
+        cache.DIRECTORY = os.path.join(self.tmp, "cache")
+        cache.RACY = 10.
+        self.filename = os.path.join(self.tmp, "params.nml")
+        del calls[:]
+
+    def tearDown(self):
+        cache.DIRECTORY, cache.RACY, cache.TOUCH = self.settings
+        shutil.rmtree(self.tmp)
+
+    def write(self, text, mtime):
+        " write the file in place (same inode), with that modification time "
+        with open(self.filename, 'w') as f:
+            f.write(text)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_hit(self):
+        self.write("a b", time.time() - 100)
+        self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b"])
+        first = cache.load(self.filename, "test", parse)
+        self.assertEqual(first, ["a", "b"])
+        self.assertEqual(len(calls), 1)
+        first.append("c")  # each call returns a new object
+        self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b"])
+
+    def test_changed(self):
+        self.write("a b", time.time() - 100)
+        cache.load(self.filename, "test", parse)
+        self.write("a b c", time.time() - 50)
+        self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b", "c"])
+        self.assertEqual(len(calls), 2)
+
+    def test_touched(self):
+        " same content with another modification time: compared by content "
+        self.write("a b", time.time() - 100)
+        cache.load(self.filename, "test", parse)
+        os.utime(self.filename, (time.time() - 50, time.time() - 50))
+        self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b"])
+        self.assertEqual(len(calls), 1)
+
+    def test_racy(self):
+        " a file changed again within RACY, with the same size and modification time "
+        mtime = int(time.time()) - 1
+        self.write("a b", mtime)
+        self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b"])
+        self.write("c d", mtime)
+        self.assertEqual(cache.load(self.filename, "test", parse), ["c", "d"])
+        self.assertEqual(len(calls), 2)
+        # unchanged: still compared by content, but not parsed again
+        self.assertEqual(cache.load(self.filename, "test", parse), ["c", "d"])
+        self.assertEqual(len(calls), 2)
+
+    def test_fingerprint(self):
+        " another parse function, or a change of its module, parses the file again "
+        self.write("a b", time.time() - 100)
+        cache.load(self.filename, "test", parse)
+        self.assertEqual(cache.load(self.filename, "test", parse_upper), ["A", "B"])
+        self.assertNotEqual(cache._entry(self.filename, "test", parse),
+                            cache._entry(self.filename, "test", parse_upper))
+        source = os.path.abspath(__file__.replace(".pyc", ".py"))
+        digest = cache._sources.get(source)
+        cache._sources[source] = "changed"
+        try:
+            cache.load(self.filename, "test", parse)
+        finally:
+            cache._sources[source] = digest
+        self.assertEqual(len(calls), 3)
+
+    def test_kind(self):
+        self.write("a b", time.time() - 100)
+        cache.load(self.filename, "test", parse)
+        cache.load(self.filename, "other", parse)
+        self.assertEqual(len(calls), 2)
+
+    def test_eviction(self):
+        " least recently used entries first "
+        cache.TOUCH = 0.
+        names = []
+        for k in range(4):
+            filename = os.path.join(self.tmp, "file{}".format(k))
+            with open(filename, 'w') as f:
+                f.write("x" * 1000)
+            os.utime(filename, (time.time() - 100, time.time() - 100))
+            cache.load(filename, "test", parse)
+            entry = cache._entry(filename, "test", parse)
+            os.utime(entry, (time.time() - 100 + k, time.time() - 100 + k))
+            names.append((filename, entry))
+        cache.load(names[0][0], "test", parse)  # used again: most recent
+        size = sum(size for _, size, _ in cache.entries())
+        cache.evict(size - 1)
+        left = set(path for _, _, path in cache.entries())
+        self.assertIn(names[0][1], left)
+        self.assertNotIn(names[1][1], left)
+        self.assertIn(names[3][1], left)
+        cache.clear()
+        self.assertEqual(cache.entries(), [])
+
+    def test_unreadable_entry(self):
+        self.write("a b", time.time() - 100)
+        cache.load(self.filename, "test", parse)
+        with open(cache._entry(self.filename, "test", parse), 'w') as f:
+            f.write("partly written")
+        self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b"])
+        self.assertEqual(len(calls), 2)
+
+class TestDisabled(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = os.environ.get(cache.CACHE_ENV)
+        os.environ[cache.CACHE_ENV] = "off"
+        reload(cache)
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, "params.nml")
+        del calls[:]
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ[cache.CACHE_ENV]
+        else:
+            os.environ[cache.CACHE_ENV] = self.environ
+        reload(cache)
+        shutil.rmtree(self.tmp)
+
+    def test_off(self):
+        self.assertFalse(cache.enabled())
+        with open(self.filename, 'w') as f:
+            f.write("a b")
+        for _ in range(2):
+            self.assertEqual(cache.load(self.filename, "test", parse), ["a", "b"])
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(os.path.exists("off"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+""" Git checksum read from .git, compared to git itself
+
+    python -m unittest discover tests
+"""
+import subprocess
+import tempfile
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import run
+
+class TestChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.checksum = os.environ.pop(run.CHECKSUM_ENV, None)
+        self.git("init", "-q")
+        self.git("config", "user.name", "test")
+        self.git("config", "user.email", "test@example.com")
+        self.write("model.f90", "program model\nend program\n")
+        self.write("params.nml", "&general\n/\n")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "first")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        if self.checksum is not None:
+            os.environ[run.CHECKSUM_ENV] = self.checksum
+
+    def git(self, *args):
+        return subprocess.check_output(["git", "-C", self.tmp] + list(args))
+
+    def write(self, name, text, mode='w'):
+        with open(os.path.join(self.tmp, name), mode) as f:
+            f.write(text)
+
+    def check(self):
+        " the checksum of the repository, as git gives it "
+        head = self.git("rev-parse", "HEAD").strip()
+        dirty = self.git("status", "--porcelain", "--untracked-files=no") != ""
+        checksum = run.get_checksum(self.tmp, safe=False)
+        self.assertEqual(checksum, head + ("-dirty" if dirty else ""))
+        return checksum
+
+    def test_loose_ref(self):
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, ".git", "refs", "heads",
+                                                    self.git("symbolic-ref", "--short", "HEAD").strip())))
+        self.assertFalse(self.check().endswith("-dirty"))
+
+    def test_packed_ref(self):
+        self.git("pack-refs", "--all")
+        self.assertFalse(os.listdir(os.path.join(self.tmp, ".git", "refs", "heads")))
+        self.check()
+        # a newer loose ref wins over the packed one
+        self.write("params.nml", "&general\n  name = 'a'\n/\n")
+        self.git("commit", "-q", "-am", "second")
+        self.check()
+
+    def test_detached(self):
+        self.write("params.nml", "&general\n  name = 'a'\n/\n")
+        self.git("commit", "-q", "-am", "second")
+        self.git("checkout", "-q", "--detach", "HEAD~1")
+        self.assertFalse(open(os.path.join(self.tmp, ".git", "HEAD")).read().startswith("ref:"))
+        self.check()
+
+    def test_dirty(self):
+        self.write("model.f90", "! changed\n", 'a')
+        self.assertTrue(self.check().endswith("-dirty"))
+        self.git("commit", "-q", "-am", "second")
+        self.assertFalse(self.check().endswith("-dirty"))
+        os.remove(os.path.join(self.tmp, "params.nml"))
+        self.assertTrue(self.check().endswith("-dirty"))
+
+    def test_untracked(self):
+        " untracked files do not count "
+        self.write("notes.txt", "notes\n")
+        self.assertFalse(self.check().endswith("-dirty"))
+
+    def test_index_v3(self):
+        " index with extended flags (intent-to-add entry) "
+        self.write("new.f90", "module new\nend module\n")
+        self.git("add", "-N", "new.f90")
+        self.git("update-index", "--index-version", "3")
+        self.check()
+
+    def test_no_commit(self):
+        shutil.rmtree(os.path.join(self.tmp, ".git"))
+        self.assertEqual(run.get_checksum(self.tmp, safe=False), "")
+        self.git("init", "-q")
+        self.assertEqual(run.get_checksum(self.tmp, safe=False), "")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+""" Preparation daemon, started from another directory than its clients
+
+    python -m unittest discover tests
+"""
+import subprocess
+import tempfile
+import unittest
+import shutil
+import time
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DAEMON = os.path.join(ROOT, "daemon.py")
+
+MODEL = """#!/bin/sh
+echo run
+"""
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.jobdir = os.path.join(self.tmp, "jobdir")
+        self.elsewhere = os.path.join(self.tmp, "elsewhere")
+        os.makedirs(self.elsewhere)
+        os.makedirs(self.jobdir)
+        for name in ("options_rembo", "options_sico"):
+            shutil.copy(os.path.join(ROOT, "examples", name), self.jobdir)
+        with open(os.path.join(self.jobdir, "param_exchange.txt"), 'w') as f:
+            f.write("# no exchanged parameters\n")
+        with open(os.path.join(self.jobdir, "sico.x"), 'w') as f:
+            f.write(MODEL)
+        os.chmod(os.path.join(self.jobdir, "sico.x"), 0755)
+
+        self.sock = os.path.join(self.tmp, "run", "daemon.sock")
+        self.env = dict(os.environ, USER=os.environ.get('USER', "user"))
+        self.env.pop('RUN_TRACE', None)
+        self.log = open(os.path.join(self.tmp, "daemon.log"), 'w')
+        self.daemon = subprocess.Popen([sys.executable, DAEMON, "--socket=" + self.sock, "--jobs=1", "start"],
+                                       cwd=self.elsewhere, env=self.env, stdout=self.log, stderr=self.log)
+        for _ in range(100):
+            if os.path.exists(self.sock) or self.daemon.poll() is not None:
+                break
+            time.sleep(0.1)
+        self.assertTrue(os.path.exists(self.sock), open(self.log.name).read())
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.client("stop")
+            self.daemon.wait()
+        self.log.close()
+        shutil.rmtree(self.tmp)
+
+    def client(self, *args):
+        " run the client from the job directory: (exit status, output) "
+        proc = subprocess.Popen([sys.executable, DAEMON, "--socket=" + self.sock] + list(args),
+                                cwd=self.jobdir, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def test_job_directory(self):
+        " the job is set up in the directory of the client "
+        status, output = self.client("job", "-f", "-o", "output/t1", "-p", "sico.x")
+        self.assertEqual(status, 0, output)
+        self.assertTrue(os.path.isfile(os.path.join(self.jobdir, "output", "t1", "options_rembo")), output)
+        self.assertFalse(os.path.exists(os.path.join(self.elsewhere, "output")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+""" Trace file shared by several processes
+
+    python -m unittest discover tests
+"""
+import tempfile
+import unittest
+import shutil
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import instrument
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, "trace.json")
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        instrument._enabled = False
+        instrument._trace_file = None
+        del instrument._events[:]
+        instrument._counters.clear()
+
+    def test_valid_json(self):
+        instrument.start(self.filename)
+        self.assertEqual(json.load(open(self.filename)), [])
+        pids = []
+        for k in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for i in range(5):
+                        with instrument.phase("step", k=k):
+                            instrument.count("files_read")
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        events = json.load(open(self.filename))
+        self.assertEqual(len([e for e in events if e['ph'] == 'X']), 20)
+        self.assertEqual(events, instrument.read_trace(self.filename))
+
+    def test_unterminated(self):
+        " a trace of the former format, without the closing bracket "
+        with open(self.filename, 'w') as f:
+            f.write('[\n{"name": "old", "ph": "i", "ts": 0, "pid": 1, "tid": 0},\n')
+        instrument.enable(self.filename)
+        with instrument.phase("new"):
+            pass
+        self.assertEqual([e['name'] for e in json.load(open(self.filename))], ["old", "new"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+""" Slicing of the batches of job (--start, --stop, --stride)
+
+    python -m unittest discover tests
+"""
+import unittest
+import imp
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+try:
+    job = imp.load_source("job_under_test", os.path.join(ROOT, "job"))
+finally:
+    if os.path.isfile(os.path.join(ROOT, "jobc")):
+        os.remove(os.path.join(ROOT, "jobc"))
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ARGS = ["pdd_factor=0.5:1.5", "year0=1"]
+
+class TestSlice(unittest.TestCase):
+
+    def test_combiner(self):
+        self.assertEqual(job.combiner_size([[1, 2], [3, 4, 5]], 1, None, 2), 3)
+        self.assertEqual(job.combiner_size([[1, 2], [3, 4, 5]], 0, 0), 0)
+
+    @unittest.skipIf(numpy is None, "sampling requires numpy")
+    def test_sample(self):
+        sets, n, design = job.parse_sample(ARGS, members=5, force=True)
+        self.assertEqual(n, 5)
+        sets, n, design = job.parse_sample(ARGS, members=5, force=True, start=1, stop=4, stride=2)
+        self.assertEqual((n, len(list(sets))), (2, 2))
+        self.assertEqual(len(design[1]), 5)  # the whole design
+
+    @unittest.skipIf(numpy is None, "sampling requires numpy")
+    def test_sample_stop_zero(self):
+        " --stop 0 sets up no member, as for parameter sweeps "
+        sets, n, design = job.parse_sample(ARGS, members=5, force=True, stop=0)
+        self.assertEqual((n, list(sets)), (0, []))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+""" Queue monitor, with fake llq and qstat scripts
+
+    python -m unittest discover tests
+"""
+import tempfile
+import unittest
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import monitor
+
+LLQ = """\
+Id                       Owner      Submitted   ST PRI Class        Running On
+------------------------ ---------- ----------- -- --- ------------ -----------
+iplex01.4321.0           user        5/27 10:11 R  50  medium       iplex02
+iplex01.4321.1           user        5/27 10:11 I  50  medium
+iplex01.999.0            other       5/27 09:00 R  50  medium       iplex03
+
+3 job step(s) in query, 1 waiting, 0 pending, 2 running, 0 held, 0 preempted
+"""
+
+QSTAT = """\
+job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
+-----------------------------------------------------------------------------------------------------------------
+    987 0.55500 rembo_sico user         r     05/27/2014 10:11:12 all.q@node1.local                  1 1
+    987 0.00000 rembo_sico user         qw    05/27/2014 10:11:02                                    1 2-6:2
+    988 0.00000 rembo_sico user         qw    05/27/2014 10:11:05                                    1
+"""
+
+def _stub(path, listing):
+    " a queue listing command which prints listing "
+    with open(path + ".txt", 'w') as f:
+        f.write(listing)
+    with open(path, 'w') as f:
+        f.write("#!/bin/sh\ncat %s.txt\n" % path)
+    os.chmod(path, 0755)
+
+class TestParse(unittest.TestCase):
+
+    def test_parse_submit(self):
+        self.assertEqual(monitor.parse_submit('llsubmit: The job "iplex01.pik-potsdam.de.123456" has been submitted.'), "123456")
+        self.assertEqual(monitor.parse_submit('llsubmit: The job "iplex01.4321" with 3 job steps has been submitted.'), "4321")
+        self.assertEqual(monitor.parse_submit('Your job 12345 ("job.submit") has been submitted'), "12345")
+        self.assertEqual(monitor.parse_submit('Your job-array 987.1-10:1 ("rembo_sico") has been submitted'), "987")
+        self.assertIsNone(monitor.parse_submit('llsubmit: Processed command file through Submit Filter'))
+
+    def test_parse_llq(self):
+        self.assertEqual(monitor.parse_llq(LLQ), {"4321.0": "R", "4321.1": "I", "999.0": "R"})
+
+    def test_parse_qstat(self):
+        self.assertEqual(monitor.parse_qstat(QSTAT), {"987.1": "r", "987.2": "qw", "987.4": "qw",
+                                                      "987.6": "qw", "988": "qw"})
+
+class TestFinished(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = self.tmp + "/"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def state(self, err, failures=None):
+        with open(self.folder + "out.err", 'w') as f:
+            f.write(err)
+        return monitor.finished(self.folder, {}, failures)
+
+    def test_failures(self):
+        for err in ["forrtl: severe (174): SIGSEGV, segmentation fault occurred\n",
+                    "Program received signal SIGFPE: Floating-point exception\n",
+                    "/bin/sh: line 1: 4321 Killed ./sico.x\n",
+                    "Error: CPU time limit exceeded\n",
+                    "job step exceeded its wall clock limit\n"]:
+            self.assertEqual(self.state(err), 'failed', err)
+
+    def test_benign(self):
+        " messages of a run going well "
+        err = "error tolerance = 1e-3\nrelative error = 1e-6\nabort_on_nan = F\nno process killed\n"
+        self.assertEqual(self.state(err), 'done')
+
+    def test_configured(self):
+        filename = os.path.join(self.tmp, "failures")
+        with open(filename, 'w') as f:
+            f.write("# the model's own messages\n^ *STOP: +[1-9]\n")
+        failures = monitor.read_failures(filename)
+        self.assertEqual(failures, ["^ *STOP: +[1-9]"])
+        self.assertEqual(self.state("  STOP: 2 (no convergence)\n", failures), 'failed')
+        self.assertEqual(self.state("forrtl: severe (174)\n", failures), 'done')
+
+    def test_tail(self):
+        " only the end of out.err is searched "
+        err = "forrtl: severe (174)\n" + "year = 1\n" * (monitor.TAIL // 8)
+        self.assertEqual(self.state(err), 'done')
+        self.assertEqual(self.state(err + "Segmentation fault\n"), 'failed')
+
+class TestPoll(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        _stub(os.path.join(self.tmp, "llq"), LLQ)
+        _stub(os.path.join(self.tmp, "qstat"), QSTAT)
+        self.environ = dict(os.environ)
+        os.environ['LLQ'] = os.path.join(self.tmp, "llq")
+        os.environ['QSTAT'] = os.path.join(self.tmp, "qstat")
+        reload(monitor)
+
+        self.batch = "output/runs/"
+        jobs = [("running", "4321.0", "ll"), ("queued", "4321.1", "ll"), ("failed", "4321.2", "ll"),
+                ("done", "4321.3", "ll"), ("missing", "4321.4", "ll"), ("task", "987.4", "sge")]
+        for name, job, queue in jobs:
+            os.makedirs(self.batch + name)
+            monitor.record(self.batch, self.batch + name + "/", job, queue=queue)
+        with open(self.batch + "failed/out.err", 'w') as f:
+            f.write("forrtl: severe (174): SIGSEGV, segmentation fault occurred\n")
+        with open(self.batch + "done/out.out", 'w') as f:
+            f.write("year = 100\n")
+        open(self.batch + "done/out.err", 'w').close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        reload(monitor)
+
+    def states(self):
+        return dict((folder.split("/")[-2], r['state']) for folder, r in monitor.read_status(self.batch).items())
+
+    def test_poll(self):
+        self.assertEqual(monitor.LLQ, os.path.join(self.tmp, "llq"))
+        counts = monitor.poll(self.batch, user="user")
+        self.assertEqual(self.states(), {"running": "running", "queued": "queued", "failed": "failed",
+                                         "done": "done", "missing": "submitted", "task": "queued"})
+        self.assertEqual(counts['submitted'], 1)
+        self.assertEqual(monitor.summary(self.batch)['counts'], counts)
+
+    def test_lost(self):
+        monitor.poll(self.batch, user="user")
+        # still not listed, and no output, once the grace time is over
+        counts = monitor.poll(self.batch, user="user", now=time.time() + monitor.GRACE + 1)
+        self.assertEqual(self.states()["missing"], "lost")
+        self.assertEqual(counts['lost'], 1)
+
+    def test_left_queue(self):
+        monitor.poll(self.batch, user="user")
+        # the running step leaves the queue with errors in its out.err
+        _stub(os.path.join(self.tmp, "llq"), LLQ.replace("iplex01.4321.0", "iplex01.1.0"))
+        with open(self.batch + "running/out.err", 'w') as f:
+            f.write("Error: CPU time limit exceeded\n")
+        monitor.poll(self.batch, user="user")
+        self.assertEqual(self.states()["running"], "failed")
+
+    def test_queue_unavailable(self):
+        os.remove(os.path.join(self.tmp, "llq"))
+        monitor.poll(self.batch, user="user")
+        self.assertEqual(self.states()["running"], "submitted")
+        self.assertEqual(self.states()["task"], "queued")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+""" Single-pass namelist tokenizer
+
+    python -m unittest discover tests
+"""
+import tempfile
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from namelist import Namelist, NamelistDocument
+from parameters import Parameters
+
+def parse(text):
+    return Namelist.parse_file(text).groups
+
+class TestParse(unittest.TestCase):
+
+    def test_scalars(self):
+        groups = parse("&g\n  a = 1\n  b = 2.5d0, c = .true. ! comment\n  d = 'x'\n/\n")
+        self.assertEqual(groups['g'].items(), [('a', 1), ('b', 2.5), ('c', True), ('d', 'x')])
+
+    def test_indexed(self):
+        groups = parse("&g\n  c(1) = 1\n  c(2) = 2\n  d(2) = 5 6\n  d(1) = 4\n/\n")
+        self.assertEqual(groups['g']['c'], [1, 2])
+        self.assertEqual(groups['g']['d'], [4, 5, 6])
+
+    def test_indexed_unfilled(self):
+        " positions left unfilled: the entries are kept as written "
+        groups = parse("&g\n  a = 0\n  c(2) = 5\n  c(4) = 7, 8\n  b = 1\n/\n")
+        self.assertEqual(groups['g'].items(), [('a', 0), ('c(2)', 5), ('c(4)', 7), ('c(5)', 8), ('b', 1)])
+        self.assertEqual(Namelist(groups).dump(), "&g\n  a = 0\n  c(2) = 5\n  c(4) = 7\n  c(5) = 8\n  b = 1\n/\n")
+
+    def test_repeat_count(self):
+        groups = parse("&g\n  a = 3*0., 1.\n  b = 2*'x'\n  c = 1*5\n/\n")
+        self.assertEqual(groups['g']['a'], [0., 0., 0., 1.])
+        self.assertEqual(groups['g']['b'], ['x', 'x'])
+        self.assertEqual(groups['g']['c'], [5])
+
+    def test_multiline(self):
+        groups = parse("&g\n  a = 1, 2,\n      3   ! end of line\n      4\n  b = /1., 2./\n  c = 1 2\n/\n")
+        self.assertEqual(groups['g']['a'], [1, 2, 3, 4])
+        self.assertEqual(groups['g']['b'], [1., 2.])
+        self.assertEqual(groups['g']['c'], [1, 2])
+
+    def test_quoted(self):
+        groups = parse("&g\n  a = 'x, y / z ! w'\n  b = 'it''s'\n  c = \"q\", 'r'\n  d = 1\n/\n")
+        self.assertEqual(groups['g']['a'], "x, y / z ! w")
+        self.assertEqual(groups['g']['b'], "it's")
+        self.assertEqual(groups['g']['c'], ["q", "r"])
+        self.assertEqual(groups['g']['d'], 1)
+
+    def test_groups(self):
+        groups = parse("text before\n&a x = 1 /\n&b\n  y = 2\n/\n")
+        self.assertEqual(groups.keys(), ['a', 'b'])
+        self.assertEqual(groups['a']['x'], 1)
+        self.assertRaises(ValueError, parse, "&a\n  x = 1\n  ) \n/\n")
+
+class TestUnfilled(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_write_nml(self):
+        " read and write back a file with a partial indexed assignment "
+        filename = os.path.join(self.tmp, "params.nml")
+        with open(filename, 'w') as f:
+            f.write("&g\n  c(2) = 5\n/\n")
+        params = Parameters.read_nml(filename, verbose=False)
+        params.write_nml(filename + ".out", verbose=False)
+        self.assertEqual(open(filename + ".out").read().strip(), "&g\n  c(2) = 5\n/")
+
+    def test_document_set(self):
+        doc = NamelistDocument("&g\n  ! keep\n  c(2) = 5\n/\n")
+        doc.set('g', 'c(2)', 6)
+        self.assertEqual(doc.dump(), "&g\n  ! keep\n  c(2) = 6\n/\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+""" Read and write back the line-by-line parameter formats
+
+    python -m unittest discover tests
+"""
+import tempfile
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import parameters
+import run
+from parameters import Parameters, LazyParameters, Template
+
+def _alex(units, name, value):
+    " a line with '=' at the 41st column "
+    return "{:<9} : {:<28}= {}".format(units, name, value)
+
+ALEX = "\n".join([
+    "# Vectors and scalars",
+    _alex("yr", "year_offset", "1.5"),
+    _alex("m", "depths", "1.0 2.0 3.0"),
+    _alex("--", "levels", "1 2 3"),
+    _alex("--", "names", "'a' 'bc'"),
+    _alex("--", "title", "plain text"),
+])
+
+CLIMBER2 = """\
+============ Vectors and scalars ===========
+ 1.5      | year_offset | offset (yr)
+ 1.0 2.0 3.0| depths | depths (m)
+ 1 2 3    | levels | levels (--)
+ 'a' 'bc'| names | names (--)"""
+
+class TestRoundTrip(unittest.TestCase):
+
+    def check(self, text, parse, write):
+        params = parse(Parameters, text)
+        written = write(params)
+        again = parse(Parameters, written)
+        self.assertEqual([p.value for p in params], [p.value for p in again])
+        self.assertEqual(write(again), written)
+        return params, written
+
+    def test_alex(self):
+        params, written = self.check(ALEX, parameters._parse_file_alex, parameters._to_str_alex)
+        self.assertEqual(params.get('depths'), [1.0, 2.0, 3.0])
+        self.assertEqual(params.get('names'), ['a', 'bc'])
+        self.assertIn("= 1.0 2.0 3.0\n", written)
+        self.assertIn("= 1 2 3\n", written)
+        self.assertNotIn("[", written)
+
+    def test_climber2(self):
+        params, written = self.check(CLIMBER2, parameters._parse_file_climber2, parameters._to_str_climber2)
+        self.assertEqual(params.get('levels'), [1, 2, 3])
+        self.assertIn(" 1.0 2.0 3.0| depths |", written)
+        self.assertIn(" 1 2 3    | levels |", written)
+        self.assertNotIn("[", written)
+
+    def test_template(self):
+        for format, text, parse in [("alex", ALEX, parameters._parse_file_alex),
+                                    ("climber2", CLIMBER2, parameters._parse_file_climber2)]:
+            params = parse(Parameters, text)
+            written = getattr(parameters, "_to_str_"+format)(params)
+            self.assertEqual(Template(params, format).render(), written)
+
+CONTROL = """\
+&general
+  name = 'first'
+/
+&time
+  year0 = 1
+/
+&general
+  name = 'second'
+/
+"""
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        with open(run.NML_CONTROL, 'w') as f:
+            f.write(CONTROL)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_glacier_name(self):
+        " the last name of repeated general groups, as when the whole file is read "
+        self.assertEqual(run.get_glacier_name(), "second")
+
+    def test_close(self):
+        mmap_size = LazyParameters.MMAP_SIZE
+        LazyParameters.MMAP_SIZE = 0  # map even small files
+        try:
+            with Parameters.read_nml(run.NML_CONTROL, verbose=False, lazy=True) as params:
+                self.assertEqual(params.get('year0', group='time'), 1)
+        finally:
+            LazyParameters.MMAP_SIZE = mmap_size
+        self.assertIsNone(params._text)
+        self.assertEqual(params.get('year0', group='time'), 1)  # already parsed
+        self.assertRaises(ValueError, params.get, 'name', group='general')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+""" Local run scheduler, resumed after a previous scheduler
+
+    python -m unittest discover tests
+"""
+import subprocess
+import tempfile
+import unittest
+import shutil
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import scheduler
+
+def _background(seconds):
+    " pid of a process which is not a child of this one, sleeping for seconds "
+    return int(subprocess.check_output("sleep {} > /dev/null 2>&1 & echo $!".format(seconds), shell=True))
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.status_file = os.path.join(self.tmp, scheduler.STATUS_FILE)
+        self.folders = [os.path.join(self.tmp, name) + "/" for name in ("a", "b")]
+        for folder in self.folders:
+            os.makedirs(folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def previous(self, pid, started):
+        " status file of a previous scheduler, killed while folder a was running "
+        with open(self.status_file, 'w') as f:
+            f.write(json.dumps(dict(run=self.folders[0], cmd=["true"], pid=pid, started=started,
+                                    start=time.time())) + "\n")
+
+    def test_run(self):
+        status = scheduler.run([(self.folders[0], ["true"]), (self.folders[1], ["false"])],
+                               nproc=2, status_file=self.status_file, poll=0.05, verbose=False)
+        self.assertEqual([scheduler.state(r) for r in status.values()], ["done", "failed"])
+        if os.path.isdir("/proc"):
+            self.assertIsNotNone(status[self.folders[0]]['started'])
+
+    def test_dead(self):
+        " a run which ended while no scheduler was waiting for it is lost "
+        proc = subprocess.Popen(["true"])
+        proc.wait()
+        self.previous(proc.pid, None)
+        self.assertEqual(scheduler.summary(self.status_file)['running'], 1)
+        scheduler.run([], status_file=self.status_file, poll=0.05, verbose=False)
+        counts = scheduler.summary(self.status_file)
+        self.assertEqual((counts['running'], counts['lost']), (0, 1))
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "process start times from /proc")
+    def test_orphan(self):
+        " a run still going is waited for, then lost "
+        pid = _background(1)
+        self.previous(pid, scheduler._started(pid))
+        t0 = time.time()
+        scheduler.run([(self.folders[0], ["true"])], status_file=self.status_file, poll=0.05, verbose=False)
+        self.assertGreater(time.time() - t0, 0.5)
+        self.assertEqual(scheduler.state(scheduler.read_status(self.status_file)[self.folders[0]]), 'lost')
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "process start times from /proc")
+    def test_pid_reused(self):
+        " a live process with the pid of the run, but started at another time "
+        pid = _background(5)
+        try:
+            self.previous(pid, scheduler._started(pid) - 1)
+            t0 = time.time()
+            scheduler.run([], status_file=self.status_file, poll=0.05, verbose=False)
+            self.assertLess(time.time() - t0, 2)
+            self.assertEqual(scheduler.summary(self.status_file)['lost'], 1)
+        finally:
+            os.kill(pid, 15)
+
+if __name__ == "__main__":
+    unittest.main()